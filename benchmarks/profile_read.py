@@ -0,0 +1,116 @@
+"""
+Сравнение старого (joined) и нового пути чтения профиля.
+
+Для пользователя с N аватарами и M категориями считается количество строк,
+которые возвращает Postgres, и средняя задержка загрузки одного профиля.
+
+Запуск: python -m benchmarks.profile_read
+"""
+import asyncio
+import datetime
+import time
+
+from sqlalchemy import event, select, delete
+
+from database.connector import engine, async_session
+from database.interface import PROFILE_LOAD_OPTIONS
+from database.models import UsersAccounts, UsersProfiles, UsersAvatars, UsersBackPads, \
+    AccountStatistic, UsersFavouritesCategories, Categories, Cities, Gender
+from endpoints.dto import UserView
+
+SIZES = [(1, 0), (10, 5), (30, 10), (100, 20)]
+ITERATIONS = 50
+
+
+def legacy_statement(_id):
+    return select(UsersAccounts).filter(UsersAccounts.id == _id)
+
+
+def profile_statement(_id):
+    return select(UsersAccounts).options(*PROFILE_LOAD_OPTIONS).filter(UsersAccounts.id == _id)
+
+
+async def seed_user(avatars: int, categories: int):
+    async with async_session() as session:
+        city_id = (await session.execute(select(Cities.id).limit(1))).scalar()
+        account = UsersAccounts(username=f"bench_{time.time_ns()}", email="bench@example.com",
+                                password="-")
+        session.add(account)
+        await session.flush()
+        category_rows = [Categories(categoryName=f"bench-{i}") for i in range(categories)]
+        session.add_all(category_rows)
+        await session.flush()
+        session.add_all(
+            [
+                UsersProfiles(accountId=account.id, firstName="Bench", lastName="User",
+                              description="", gender=Gender.male,
+                              dateOfBirth=datetime.date(2000, 1, 1), city_id=city_id),
+                UsersBackPads(accountId=account.id, mediaUrl="back-pad"),
+                AccountStatistic(accountId=account.id, totalEvents=0, totalFriends=0),
+                *[UsersAvatars(accountId=account.id, mediaUrl=f"avatar-{i}") for i in range(avatars)],
+                *[UsersFavouritesCategories(accountId=account.id, categoryId=category.id)
+                  for category in category_rows],
+            ]
+        )
+        await session.commit()
+        return account.id, [category.id for category in category_rows]
+
+
+async def drop_user(_id, category_ids):
+    async with async_session() as session:
+        await session.execute(delete(UsersAccounts).filter(UsersAccounts.id == _id))
+        await session.execute(delete(Categories).filter(Categories.id.in_(category_ids)))
+        await session.commit()
+
+
+async def fetched_rows(statement) -> int:
+    """Выполняет запрос и считает строки всех SQL-запросов, которые он породил"""
+    executed = []
+
+    def capture(conn, cursor, sql, parameters, context, executemany):
+        executed.append((sql, parameters))
+
+    event.listen(engine.sync_engine, "before_cursor_execute", capture)
+    try:
+        async with async_session() as session:
+            result = await session.execute(statement)
+            result.unique().scalars().all()
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", capture)
+
+    total = 0
+    async with engine.connect() as conn:
+        for sql, parameters in executed:
+            count = await conn.exec_driver_sql(f"SELECT count(*) FROM ({sql}) AS q", parameters)
+            total += count.scalar()
+    return total
+
+
+async def latency(statement) -> float:
+    tm_start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        async with async_session() as session:
+            result = await session.execute(statement)
+            UserView.model_validate(result.unique().scalars().first())
+    return (time.perf_counter() - tm_start) / ITERATIONS * 1000
+
+
+async def main():
+    print(f"{'avatars':>8} {'categories':>10} | {'rows old':>8} {'rows new':>8} | "
+          f"{'ms old':>7} {'ms new':>7}")
+    for avatars, categories in SIZES:
+        _id, category_ids = await seed_user(avatars, categories)
+        try:
+            rows_old = await fetched_rows(legacy_statement(_id))
+            rows_new = await fetched_rows(profile_statement(_id))
+            ms_old = await latency(legacy_statement(_id))
+            ms_new = await latency(profile_statement(_id))
+        finally:
+            await drop_user(_id, category_ids)
+        print(f"{avatars:>8} {categories:>10} | {rows_old:>8} {rows_new:>8} | "
+              f"{ms_old:>7.2f} {ms_new:>7.2f}")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
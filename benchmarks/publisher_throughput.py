@@ -0,0 +1,64 @@
+"""
+Скорость публикации в RabbitMQ: соединение на каждое сообщение (прежний
+publish_message) и пул каналов Publisher.
+
+Сообщения уходят в временную очередь, которая удаляется после замера.
+
+Запуск: python -m benchmarks.publisher_throughput [сообщений] [параллельность]
+"""
+import asyncio
+import sys
+import time
+
+import aio_pika
+
+from config import settings
+from helpers.publisher import Publisher, _create_message
+
+QUEUE = "benchmark-publisher"
+BODY = b'{"userId": "3f1c1a3e-5d3c-4c39-9d5e-0d1f3f6a2b7c", "target": "avatar"}'
+
+
+async def connection_per_message():
+    connection = await aio_pika.connect_robust(settings.rabbit_conn)
+    async with connection:
+        channel = await connection.channel()
+        await channel.default_exchange.publish(_create_message(BODY), routing_key=QUEUE)
+
+
+async def pooled():
+    await Publisher.publish(BODY, QUEUE)
+
+
+async def run(publish, total: int, concurrency: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            await publish()
+
+    tm_start = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(total)])
+    return total / (time.perf_counter() - tm_start)
+
+
+async def main(total: int, concurrency: int):
+    connection = await aio_pika.connect_robust(settings.rabbit_conn)
+    async with connection:
+        channel = await connection.channel()
+        queue = await channel.declare_queue(QUEUE, auto_delete=True)
+        await Publisher.connect()
+        try:
+            before = await run(connection_per_message, total, concurrency)
+            after = await run(pooled, total, concurrency)
+        finally:
+            await Publisher.close()
+            await queue.delete(if_unused=False, if_empty=False)
+    print(f"messages: {total}, concurrency: {concurrency}")
+    print(f"connection per message: {before:8.1f} msg/s")
+    print(f"channel pool:           {after:8.1f} msg/s")
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:3]]
+    asyncio.run(main(*(args + [2000, 20][len(args):])))
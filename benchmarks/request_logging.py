@@ -0,0 +1,125 @@
+"""
+Накладные расходы router_decorator на один запрос: прежняя версия (f-строки,
+str(request.headers) даже без DEBUG, синхронная запись в RotatingFileHandler
+на event loop) и текущая (ленивое форматирование, JSON в потоке
+QueueListener, выборка успешных запросов LOG_SAMPLE_RATE).
+
+Обработчик запроса ничего не делает, логи пишутся во временный каталог.
+Время текущей версии включает ожидание, пока слушатель допишет очередь.
+
+Запуск: python -m benchmarks.request_logging [запросов] [доля выборки]
+"""
+import asyncio
+import logging
+import logging.handlers
+import os
+import sys
+import tempfile
+import time
+import uuid
+from functools import wraps
+
+from fastapi import HTTPException, Request
+
+from config import settings
+from helpers import decorators
+from helpers.log import JsonFormatter, _enqueue, stop_logging
+
+before_logger = logging.getLogger("benchmark.before")
+before_sys_logger = logging.getLogger("benchmark.before.sys")
+
+
+def old_router_decorator(request: Request):
+    def decorator(coro):
+        @wraps(coro)
+        async def wrapper(*args, **kwargs):
+            tm_start = time.time()
+            request_id = str(uuid.uuid4())
+            before_logger.info(
+                f"Start handling request [{request.method}] - {request.url}. Assigned ID: {request_id}"
+            )
+            before_logger.debug(
+                f"RequestID: {request_id} - request: {str(request.headers)}; "
+                f"Query: {str(request.query_params)}; Body: {str(request.body)}"
+            )
+            try:
+                return await coro(*args, **kwargs)
+            except HTTPException:
+                raise
+            finally:
+                tm_end = time.time()
+                before_logger.info(
+                    f"Finish handling request [{request.method}] - {request.url} RequestID: {request_id}"
+                )
+                before_sys_logger.info(
+                    f"Handling request {request_id} took {tm_end - tm_start:.2f}s; "
+                )
+        return wrapper
+    return decorator
+
+
+def make_request() -> Request:
+    return Request({
+        "type": "http",
+        "method": "GET",
+        "scheme": "http",
+        "server": ("benchmark", 80),
+        "path": "/v2/users/profile",
+        "query_string": b"username=john_doe",
+        "headers": [
+            (b"host", b"benchmark"),
+            (b"user-agent", b"benchmark/1.0"),
+            (b"authorization", b"Bearer " + b"x" * 200),
+            (b"accept", b"application/json"),
+        ],
+    })
+
+
+def file_handler(directory: str, name: str, formatter: logging.Formatter) -> logging.Handler:
+    handler = logging.handlers.RotatingFileHandler(
+        os.path.join(directory, name), maxBytes=100 * 1024 * 1024, backupCount=1
+    )
+    handler.setFormatter(formatter)
+    return handler
+
+
+async def measure(router_decorator, count: int) -> float:
+    request = make_request()
+
+    async def handler():
+        return None
+
+    tm_start = time.perf_counter()
+    for _ in range(count):
+        await router_decorator(request)(handler)()
+    return time.perf_counter() - tm_start
+
+
+async def main(count: int, sample_rate: float):
+    directory = tempfile.mkdtemp(prefix="logging-bench-")
+    simple = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    for logger in (before_logger, before_sys_logger, decorators.logger):
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    before_logger.addHandler(file_handler(directory, "before.log", simple))
+    before_sys_logger.addHandler(file_handler(directory, "before_sys.log", simple))
+    decorators.logger.addHandler(file_handler(directory, "after.log", JsonFormatter()))
+    _enqueue(decorators.logger)
+    settings.LOG_SAMPLE_RATE = sample_rate
+
+    before = await measure(old_router_decorator, count)
+    after = await measure(decorators.router_decorator, count)
+    tm_start = time.perf_counter()
+    stop_logging()
+    drain = time.perf_counter() - tm_start
+
+    print(f"requests: {count}, sample rate: {sample_rate}")
+    print(f"before: {before / count * 1e6:8.1f} us/request")
+    print(f"after:  {after / count * 1e6:8.1f} us/request on the event loop, "
+          f"{(after + drain) / count * 1e6:8.1f} us/request with queue drain")
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    sample_rate = float(sys.argv[2]) if len(sys.argv) > 2 else settings.LOG_SAMPLE_RATE
+    asyncio.run(main(count, sample_rate))
@@ -0,0 +1,133 @@
+"""
+Пропускная способность создания пользователей при параллельных регистрациях.
+
+Сравнивается прежний путь (SELECT города, INSERT аккаунта с flush, INSERT
+зависимых строк, COMMIT) и DatabaseInterface.create_user (один запрос из
+цепочки CTE). Bcrypt заменяется готовым хэшем, чтобы измерялась только работа
+с БД. Сравнение не один к одному: create_user дополнительно пишет два
+сообщения outbox и добавляет имя в фильтр имен, прежний путь - нет.
+
+Запускать при остановленном сервисе: OutboxRelay отправил бы письма и
+уведомления о регистрации тестовых пользователей раньше, чем cleanup удалит
+их сообщения.
+
+Запуск: python -m benchmarks.signup_throughput [количество] [параллельность]
+"""
+import asyncio
+import sys
+import time
+
+import redis.asyncio as aioredis
+from fastapi_cache import FastAPICache
+from fastapi_cache.backends.redis import RedisBackend
+from sqlalchemy import select, delete
+
+from config import settings
+from database.connector import async_session, engine
+from database.interface import DatabaseInterface
+from database.models import UsersAccounts, UsersProfiles, UsersAvatars, UsersBackPads, \
+    AccountStatistic, Cities, OutboxMessages
+from endpoints.dto import UserCreateModel
+from helpers.cloud_storage import CloudMediaStorageAdapter
+from helpers.geo import GeoIndex
+from helpers.security import Hasher
+from helpers.username_filter import UsernameFilter
+
+PREFIX = "bench_signup_"
+PASSWORD_HASH = Hasher.get_hash_password("password")
+
+
+async def precomputed_hash(cls, password: str) -> str:
+    return PASSWORD_HASH
+
+
+async def legacy_create_user(body: UserCreateModel):
+    async with async_session() as session:
+        city_id = await session.execute(
+            select(Cities.id).where(Cities.name == body.city)
+        )
+        city_id = city_id.scalar()
+        user_account = UsersAccounts(
+            username=body.username,
+            email=body.email,
+            password=PASSWORD_HASH,
+        )
+        session.add(user_account)
+        await session.flush()
+        _id = user_account.id
+        session.add_all(
+            [
+                UsersProfiles(accountId=_id, firstName=body.firstName, lastName=body.lastName,
+                              gender=body.gender, dateOfBirth=body.dateOfBirth,
+                              city_id=city_id, description=body.description),
+                UsersAvatars(accountId=_id, mediaUrl=CloudMediaStorageAdapter.get_default_avatar()),
+                UsersBackPads(accountId=_id,
+                              mediaUrl=CloudMediaStorageAdapter.get_default_back_pad()),
+                AccountStatistic(accountId=_id, totalEvents=0, totalFriends=0),
+            ]
+        )
+        await session.commit()
+        return _id
+
+
+def make_body(tag: str, i: int) -> UserCreateModel:
+    return UserCreateModel(
+        username=f"{PREFIX}{tag}_{i}",
+        password="password",
+        email=f"{PREFIX}{tag}{i}@example.com",
+        dateOfBirth="2000-01-01",
+        description="",
+    )
+
+
+async def run(create, tag: str, total: int, concurrency: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with semaphore:
+            await create(make_body(tag, i))
+
+    tm_start = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(total)])
+    return total / (time.perf_counter() - tm_start)
+
+
+async def cleanup():
+    async with async_session() as session:
+        usernames = await session.execute(
+            delete(UsersAccounts).filter(UsersAccounts.username.like(f"{PREFIX}%"))
+            .returning(UsersAccounts.username)
+        )
+        usernames = usernames.scalars().all()
+        # Имя и почта есть в сообщениях create_user о регистрации
+        await session.execute(
+            delete(OutboxMessages).filter(OutboxMessages.payload.like(f"%{PREFIX}%"))
+        )
+        await session.commit()
+    # В фильтр имена добавляет только create_user
+    for username in usernames:
+        if username.startswith(f"{PREFIX}cte_"):
+            await UsernameFilter.remove(username)
+
+
+async def main(total: int, concurrency: int):
+    redis = aioredis.from_url(f"redis://{settings.REDIS_HOST}", encoding="utf-8", decode_responses=True)
+    FastAPICache.init(RedisBackend(redis), prefix="fastapi-cache")
+    await GeoIndex.load()
+    Hasher.hash_password = classmethod(precomputed_hash)
+    await cleanup()
+    try:
+        legacy = await run(legacy_create_user, "legacy", total, concurrency)
+        single = await run(lambda body: DatabaseInterface.create_user(body, 12345), "cte",
+                           total, concurrency)
+    finally:
+        await cleanup()
+        await engine.dispose()
+    print(f"signups: {total}, concurrency: {concurrency}")
+    print(f"legacy path:      {legacy:8.1f} signups/s")
+    print(f"single statement: {single:8.1f} signups/s (plus 2 outbox rows and a filter update)")
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:3]]
+    asyncio.run(main(*(args + [1000, 50][len(args):])))
@@ -0,0 +1,74 @@
+"""
+Пути загрузки и удаления медиа без сети: stage_stream + store (как у подложек)
+и delete_media пачками, поверх хранилища в памяти или в локальном каталоге.
+
+Измеряется накладная часть сервиса: пул потоков, ограничение параллельности,
+сборка частей и хэширование. Файлы больше S3_UPLOAD_PART_SIZE идут через
+временный ключ uploads/ и копирование.
+
+Запуск: python -m benchmarks.storage_paths [memory|local] [количество] [размер файла, КБ] [параллельность]
+"""
+import asyncio
+import shutil
+import sys
+import tempfile
+import time
+
+from helpers.cloud_storage import CloudMediaStorageAdapter
+from helpers.storage import LocalStorageBackend, MemoryStorageBackend
+
+BUCKET = "benchmark"
+CHUNK = 64 * 1024
+
+
+async def chunks(index: int, size: int):
+    # Разное содержимое, чтобы ключи по sha256 не совпадали
+    yield index.to_bytes(8, "big")
+    for start in range(0, size, CHUNK):
+        yield b"\0" * min(CHUNK, size - start)
+
+
+async def upload(index: int, size: int, semaphore: asyncio.Semaphore) -> str:
+    async with semaphore:
+        staged = await CloudMediaStorageAdapter.stage_stream(BUCKET, chunks(index, size), suffix=".png")
+        try:
+            await staged.store()
+        finally:
+            await staged.discard()
+    return staged.key
+
+
+async def main(backend: str, count: int, size_kb: int, concurrency: int):
+    directory = None
+    if backend == "local":
+        directory = tempfile.mkdtemp(prefix="storage-bench-")
+        CloudMediaStorageAdapter.use_backend(LocalStorageBackend(directory))
+    else:
+        CloudMediaStorageAdapter.use_backend(MemoryStorageBackend())
+    size = size_kb * 1024
+    semaphore = asyncio.Semaphore(concurrency)
+    try:
+        tm_start = time.perf_counter()
+        keys = await asyncio.gather(*[upload(index, size, semaphore) for index in range(count)])
+        upload_elapsed = time.perf_counter() - tm_start
+
+        tm_start = time.perf_counter()
+        failed = await CloudMediaStorageAdapter.delete_media(BUCKET, keys)
+        delete_elapsed = time.perf_counter() - tm_start
+        assert not failed, failed
+        objects, _ = await CloudMediaStorageAdapter.list_objects(BUCKET, None, 1)
+        assert not objects, objects
+    finally:
+        CloudMediaStorageAdapter.shutdown()
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    print(f"backend: {backend}, files: {count} x {size_kb} KB, concurrency: {concurrency}")
+    print(f"upload: {upload_elapsed:8.3f} s  {count / upload_elapsed:10.0f} files/s")
+    print(f"delete: {delete_elapsed:8.3f} s  {count / delete_elapsed:10.0f} keys/s")
+
+
+if __name__ == "__main__":
+    backend = sys.argv[1] if len(sys.argv) > 1 else "memory"
+    args = [int(arg) for arg in sys.argv[2:5]]
+    asyncio.run(main(backend, *(args + [2000, 64, 10][len(args):])))
@@ -0,0 +1,53 @@
+"""
+Микробенчмарк проверки JWT: без кэша и через Authenticator.get_user_by_token.
+
+Запуск: python -m benchmarks.token_cache [итераций]
+"""
+import asyncio
+import sys
+import time
+
+from jose import jwt
+
+from config import settings
+from endpoints.dto import TokenData
+from helpers.security import Authenticator
+
+
+def make_token() -> str:
+    payload = {
+        "id": "3f1c1a3e-5d3c-4c39-9d5e-0d1f3f6a2b7c",
+        "username": "john_doe",
+        "city": 1,
+        "categories": [1, 2, 3],
+        "exp": int(time.time()) + 3600,
+    }
+    return jwt.encode(payload, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
+
+
+def uncached(token: str) -> TokenData:
+    payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+    return TokenData.model_validate(payload)
+
+
+async def main(iterations: int):
+    token = make_token()
+
+    tm_start = time.perf_counter()
+    for _ in range(iterations):
+        uncached(token)
+    plain = (time.perf_counter() - tm_start) / iterations * 1e6
+
+    tm_start = time.perf_counter()
+    for _ in range(iterations):
+        await Authenticator.get_user_by_token(token)
+    cached = (time.perf_counter() - tm_start) / iterations * 1e6
+
+    print(f"iterations: {iterations}")
+    print(f"uncached: {plain:8.2f} us/call")
+    print(f"cached:   {cached:8.2f} us/call")
+    print(f"cache:    {Authenticator.stats()}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000))
@@ -0,0 +1,101 @@
+"""
+Пиковая память при параллельной загрузке аватаров: прежний путь
+(bytes = File(...) и один put_object) и потоковая загрузка stream_file ->
+upload_stream частями S3_UPLOAD_PART_SIZE.
+
+Запросы идут в приложение напрямую через ASGI телом по 64 КБ, S3-клиент
+заменяется хранилищем, которое отбрасывает данные, поэтому измеряется только
+память сервиса (tracemalloc).
+
+Запуск: python -m benchmarks.upload_memory [параллельность] [размер файла, МБ]
+"""
+import asyncio
+import sys
+import tracemalloc
+
+import httpx
+from fastapi import FastAPI, File, Request
+
+from config import settings
+from helpers.cloud_storage import CloudMediaStorageAdapter
+from helpers.storage import MemoryStorageBackend
+from helpers.uploads import stream_file
+
+CHUNK = 64 * 1024
+BOUNDARY = "benchmark-boundary"
+# Ограничение размера в замере не проверяется
+SIZE_LIMIT = 1 << 40
+
+
+class DiscardingBackend(MemoryStorageBackend):
+    name = "discard"
+
+    def put(self, bucket, key, body, content_type=None):
+        pass
+
+    def upload_part(self, bucket, key, upload_id, number, body):
+        return str(number)
+
+    def complete_multipart(self, bucket, key, upload_id, parts):
+        self.abort_multipart(bucket, key, upload_id)
+
+
+app = FastAPI()
+
+
+@app.post("/buffered")
+async def buffered(avatar: bytes = File(...)):
+    await CloudMediaStorageAdapter._call("put", "benchmark", "avatar", avatar)
+
+
+@app.post("/streamed")
+async def streamed(request: Request):
+    await CloudMediaStorageAdapter.upload_stream(
+        "benchmark", "avatar", stream_file(request, "avatar", SIZE_LIMIT)
+    )
+
+
+async def multipart_body(size: int):
+    yield (
+        f"--{BOUNDARY}\r\n"
+        f'Content-Disposition: form-data; name="avatar"; filename="avatar.png"\r\n'
+        f"Content-Type: image/png\r\n\r\n"
+    ).encode()
+    chunk = b"\0" * CHUNK
+    for _ in range(size // CHUNK):
+        yield chunk
+    yield f"\r\n--{BOUNDARY}--\r\n".encode()
+
+
+async def run(path: str, concurrency: int, size: int) -> float:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        tracemalloc.start()
+        responses = await asyncio.gather(*[
+            client.post(
+                path,
+                content=multipart_body(size),
+                headers={"content-type": f"multipart/form-data; boundary={BOUNDARY}"},
+            )
+            for _ in range(concurrency)
+        ])
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    assert all(response.status_code == 200 for response in responses), responses
+    return peak / 1024 / 1024
+
+
+async def main(concurrency: int, size_mb: int):
+    size = size_mb * 1024 * 1024
+    CloudMediaStorageAdapter.use_backend(DiscardingBackend())
+    buffered_peak = await run("/buffered", concurrency, size)
+    streamed_peak = await run("/streamed", concurrency, size)
+    print(f"uploads: {concurrency} x {size_mb} MB, part size: "
+          f"{settings.S3_UPLOAD_PART_SIZE // 1024 // 1024} MB")
+    print(f"bytes = File(...): {buffered_peak:8.1f} MB peak")
+    print(f"streamed:          {streamed_peak:8.1f} MB peak")
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:3]]
+    asyncio.run(main(*(args + [10, 8][len(args):])))
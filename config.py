@@ -1,7 +1,5 @@
-import logging.config
 import os
 
-import yaml
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -19,10 +17,18 @@ class Settings(BaseSettings):
     SECRET_KEY: str
     ALGORITHM: str
     EXPIRE_TIME: str
-    SELECTEL_S3_ACCESS_KEY: str
-    SELECTEL_S3_SECRET_KEY: str
+    SELECTEL_S3_ACCESS_KEY: str | None = None
+    SELECTEL_S3_SECRET_KEY: str | None = None
     BUCKET_NAME_AVATARS: str
     BUCKET_NAME_BACK_PADS: str
+    STORAGE_BACKEND: str = "s3"
+    STORAGE_LOCAL_PATH: str = "media"
+    STORAGE_PRESIGN_URL: str = "http://localhost/storage"
+    S3_ENDPOINT_URL: str = "https://s3.storage.selcloud.ru"
+    S3_REGION: str = "ru-1"
+    # Адрес хранилища для клиентов, если отличается от адреса внутри сети
+    S3_PUBLIC_ENDPOINT_URL: str | None = None
+    S3_ADDRESSING_STYLE: str = "auto"
     RABBIT_LOGIN: str
     RABBIT_PASSWORD: str
     RABBIT_HOST: str
@@ -36,6 +42,59 @@ class Settings(BaseSettings):
     EVENT_SERVICE_TOKEN: str
     ORGANISER_SERVICE_URL: str
     ORGANISER_SERVICE_TOKEN: str
+    STATISTIC_FLUSH_INTERVAL: float = 1.0
+    USERNAME_FILTER_CAPACITY: int = 1_000_000
+    USERNAME_FILTER_ERROR_RATE: float = 0.01
+    BCRYPT_ROUNDS: int = 12
+    HASHER_POOL_SIZE: int = 4
+    TOKEN_CACHE_SIZE: int = 10000
+    TOKEN_CACHE_TTL: float = 300
+    PROFILE_CACHE_EXPIRE: int = 3600
+    PROFILE_LOCAL_CACHE_SIZE: int = 5000
+    PROFILE_LOCAL_CACHE_TTL: float = 60
+    PROFILE_CACHE_STALE: int = 300
+    PROFILE_LOCK_TIMEOUT: float = 5.0
+    RABBIT_CHANNEL_POOL_SIZE: int = 10
+    OUTBOX_BATCH_SIZE: int = 200
+    OUTBOX_POLL_INTERVAL: float = 0.5
+    NOTIFICATION_COALESCE_WINDOW: float = 2.0
+    NOTIFICATION_COALESCE_MAX_WAIT: float = 10.0
+    CROSS_SERVICE_HTTP2: bool = False
+    CROSS_SERVICE_TIMEOUT: float = 5.0
+    CROSS_SERVICE_CONNECT_TIMEOUT: float = 2.0
+    CROSS_SERVICE_MAX_CONNECTIONS: int = 50
+    CROSS_SERVICE_MAX_KEEPALIVE: int = 20
+    CROSS_SERVICE_RETRIES: int = 3
+    CROSS_SERVICE_BACKOFF: float = 0.2
+    CROSS_SERVICE_BACKOFF_MAX: float = 5.0
+    CROSS_SERVICE_BREAKER_THRESHOLD: int = 5
+    CROSS_SERVICE_BREAKER_RESET: float = 30.0
+    COMMUNITY_BATCH_PATH: str = "/register/batch"
+    COMMUNITY_BATCH_SIZE: int = 100
+    COMMUNITY_BATCH_WINDOW: float = 0.5
+    COMMUNITY_QUEUE_SIZE: int = 5000
+    COMMUNITY_FALLBACK_CONCURRENCY: int = 10
+    COMMUNITY_RETRY_INTERVAL: float = 5.0
+    COMMUNITY_RETRY_MAX_INTERVAL: float = 300.0
+    S3_MAX_CONCURRENCY: int = 10
+    S3_UPLOAD_PART_SIZE: int = 5 * 1024 * 1024
+    UPLOAD_MAX_SIZE: int = 10 * 1024 * 1024
+    PRESIGNED_UPLOAD_EXPIRE: int = 600
+    MEDIA_GC_INTERVAL: float = 60
+    MEDIA_GC_GRACE: int = 6 * 3600
+    MEDIA_GC_BATCH_SIZE: int = 1000
+    MEDIA_GC_RATE: float = 500
+    IMAGE_POOL_SIZE: int = 2
+    AVATAR_THUMBNAIL_SIZE: int = 96
+    AVATAR_MEDIUM_SIZE: int = 512
+    AVATAR_ORIGINAL_MAX_SIZE: int = 2048
+    AVATAR_MAX_PIXELS: int = 40_000_000
+    AVATAR_WEBP_QUALITY: int = 80
+    # Доля успешных запросов, которые попадают в лог, ошибки логируются всегда
+    LOG_SAMPLE_RATE: float = 0.1
+    # Каталог для метрик всех воркеров, без него метрики отдает только текущий процесс
+    PROMETHEUS_MULTIPROC_DIR: str | None = None
+    METRICS_LOOP_LAG_INTERVAL: float = 0.5
 
     @property
     def DATABASE_URL_asyncpg(self):
@@ -62,9 +121,3 @@ class Settings(BaseSettings):
 settings = Settings()
 
 
-def setup_logging():
-    with open('logging.yml', 'r') as f:
-        config = yaml.safe_load(f.read())
-        logging.config.dictConfig(config)
-
-
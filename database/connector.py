@@ -1,11 +1,49 @@
-from sqlalchemy import create_engine
+import contextvars
+import time
+
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from config import settings
+from helpers.metrics import DB_POOL_CHECKED_OUT, DB_POOL_CHECKOUT_WAIT, DB_QUERY_DURATION, \
+    statement_kind
+
+# Время открытия соединений в текущем контексте, общий счетчик пула
+# перемешал бы соединения, которые одновременно открывают разные запросы
+_connect_time: contextvars.ContextVar[float] = contextvars.ContextVar("pool_connect_time", default=0.0)
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+
+    """
+    Пул соединений с замером ожидания свободного соединения
+
+    Время открытия нового соединения, когда пул растет, вычитается из
+    ожидания, чтобы медленное подключение к базе не выглядело как нехватка пула.
+    """
+
+    def _create_connection(self):
+        tm_start = time.perf_counter()
+        try:
+            return super()._create_connection()
+        finally:
+            _connect_time.set(_connect_time.get() + time.perf_counter() - tm_start)
+
+    def _do_get(self):
+        tm_start = time.perf_counter()
+        connect_start = _connect_time.get()
+        try:
+            return super()._do_get()
+        finally:
+            connect = _connect_time.get() - connect_start
+            DB_POOL_CHECKOUT_WAIT.observe(max(0.0, time.perf_counter() - tm_start - connect))
+
 
 engine = create_async_engine(
     url=settings.DATABASE_URL_asyncpg,
     echo=False,
+    poolclass=InstrumentedPool,
     pool_size=10,
     max_overflow=20,
     pool_timeout=30,
@@ -17,6 +55,38 @@ sync_engine = create_engine(
     echo=False,
 )
 
+
+@event.listens_for(engine.sync_engine, "checkout")
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    DB_POOL_CHECKED_OUT.inc()
+
+
+@event.listens_for(engine.sync_engine, "checkin")
+def _on_checkin(dbapi_connection, connection_record):
+    DB_POOL_CHECKED_OUT.dec()
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(engine.sync_engine, "after_cursor_execute")
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    tm_start = conn.info["query_start"].pop()
+    DB_QUERY_DURATION.labels(statement_kind(statement)).observe(time.perf_counter() - tm_start)
+
+
+@event.listens_for(engine.sync_engine, "handle_error")
+def _on_error(context):
+    starts = context.connection.info.get("query_start") if context.connection is not None else None
+    if starts:
+        tm_start = starts.pop()
+        DB_QUERY_DURATION.labels(statement_kind(context.statement or "")).observe(
+            time.perf_counter() - tm_start
+        )
+
+
 async_session = async_sessionmaker(bind=engine, autoflush=False, autocommit=False)
 
 
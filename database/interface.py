@@ -1,79 +1,162 @@
-from sqlalchemy import select, update, delete
+import collections
+import datetime
+import uuid
 
-from database.connector import async_session
+from sqlalchemy import select, insert, update, delete, bindparam, case
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import joinedload, selectinload, noload
+
+from database.connector import async_session, engine
 from database.models import *
-from endpoints.dto import UserCreateModel
-from helpers.cloud_storage import CloudMediaStorageAdapter
+from endpoints.dto import UserCreateModel, EmailSenderData, FirebaseToken, UpdateAvatar
+from helpers.cache import ProfileCache
+from helpers.cloud_storage import Buckets, CloudMediaStorageAdapter, StagedAvatar, StagedUpload, \
+    DEFAULT_KEYS
+from helpers.geo import GeoIndex
 from helpers.security import Hasher
+from helpers.username_filter import UsernameFilter
+from messages.notifications import DropUser
+
+# Загрузка профиля без декартова произведения: коллекция аватаров подгружается
+# отдельным IN-запросом, категории не загружаются - UserView их не отдает
+PROFILE_LOAD_OPTIONS = (
+    joinedload(UsersAccounts.profile)
+    .joinedload(UsersProfiles.city)
+    .noload(Cities.federal_district),
+    selectinload(UsersAccounts.usersAvatars),
+    joinedload(UsersAccounts.usersBackPad),
+    joinedload(UsersAccounts.accountStatistic),
+    noload(UsersAccounts.categories),
+)
+
+
+def outbox_message(data, queue, coalesce_key=None) -> dict:
+    """
+    Строка outbox_messages для публикации data в очередь queue
+
+    :param coalesce_key: из сообщений с одинаковым ключом, пришедших в окне
+        NOTIFICATION_COALESCE_WINDOW, отправляется только последнее
+    """
+    return {
+        "queue": queue,
+        "payload": data.model_dump_json(),
+        "coalesce_key": coalesce_key,
+        "created_at": datetime.datetime.utcnow()
+    }
 
 
 class DatabaseInterface:
     @classmethod
-    async def create_user(cls, body: UserCreateModel):
-        async with async_session() as session:
-            city_id = await session.execute(
-                select(Cities.id).where(Cities.name == body.city)
-            )
-            city_id = city_id.scalar()
-            user_account = UsersAccounts(
+    async def create_user(cls, body: UserCreateModel, verification_code):
+        password = await Hasher.hash_password(body.password)
+        _id = uuid.uuid4()
+        now = datetime.datetime.utcnow()
+        default_avatar = CloudMediaStorageAdapter.get_default_avatar()
+        # Аккаунт и все зависимые строки создаются одним запросом из цепочки
+        # CTE, id генерируется на клиенте, проверка внешних ключей в Postgres
+        # выполняется в конце запроса
+        account = (
+            insert(UsersAccounts)
+            .values(
+                id=_id,
                 username=body.username,
                 email=body.email,
-                password=Hasher.get_hash_password(body.password),
+                password=password,
+                isOpenAccount=True,
+                primeStatus=False,
+                created_at=now
             )
-            session.add(user_account)
-            await session.flush()
-            _id = user_account.id
-            default_avatar = CloudMediaStorageAdapter.get_default_avatar()
-            user_profile = UsersProfiles(
+            .returning(UsersAccounts.id)
+            .cte("new_account")
+        )
+        statement = select(account.c.id).add_cte(
+            insert(UsersProfiles).values(
                 accountId=_id,
                 firstName=body.firstName,
                 lastName=body.lastName,
-                gender=body.gender.value,
+                gender=body.gender,
                 dateOfBirth=body.dateOfBirth,
-                city_id=city_id,
+                city_id=GeoIndex.city_id(body.city),
                 description=body.description
-            )
-            user_avatar = UsersAvatars(
+            ).cte("new_profile"),
+            insert(UsersAvatars).values(
                 accountId=_id,
-                mediaUrl=default_avatar
-            )
-            user_back_pad = UsersBackPads(
+                mediaUrl=default_avatar,
+                created_at=now
+            ).cte("new_avatar"),
+            insert(UsersBackPads).values(
                 accountId=_id,
-                mediaUrl=CloudMediaStorageAdapter.get_default_back_pad()
-            )
-            account_statistic = AccountStatistic(
+                mediaUrl=CloudMediaStorageAdapter.get_default_back_pad(),
+                created_at=now
+            ).cte("new_back_pad"),
+            insert(AccountStatistic).values(
                 accountId=_id,
                 totalEvents=0,
                 totalFriends=0
-            )
-            session.add_all(
+            ).cte("new_statistic"),
+            insert(OutboxMessages).values(
                 [
-                    user_profile,
-                    user_avatar,
-                    user_back_pad,
-                    account_statistic
+                    outbox_message(
+                        EmailSenderData(
+                            email=body.email,
+                            target="verification",
+                            verification_code=str(verification_code)
+                        ),
+                        "email"
+                    ),
+                    outbox_message(
+                        FirebaseToken(
+                            target="token",
+                            firebaseToken=body.firebaseToken,
+                            username=body.username,
+                            userId=str(_id),
+                            mediaUrl=default_avatar
+                        ),
+                        "notification"
+                    ),
                 ]
-            )
+            ).cte("new_messages"),
+        )
+        async with engine.connect() as connection:
+            connection = await connection.execution_options(isolation_level="AUTOCOMMIT")
+            await connection.execute(statement)
+        await UsernameFilter.add(body.username)
+        return _id, default_avatar
+
+    @classmethod
+    async def enqueue_message(cls, data, queue, coalesce_key=None):
+        """Сообщение без изменения данных, отправляется через outbox"""
+        async with async_session() as session:
+            session.add(OutboxMessages(**outbox_message(data, queue, coalesce_key)))
             await session.commit()
-            return _id, default_avatar
 
     @classmethod
     async def get_user_by_id(cls, _id):
         async with async_session() as session:
-            user = select(UsersAccounts).filter(UsersAccounts.id == _id)
+            user = (
+                select(UsersAccounts)
+                .options(*PROFILE_LOAD_OPTIONS)
+                .filter(UsersAccounts.id == _id)
+            )
             user = await session.execute(user)
-            user = user.unique().scalars().all()
-            return user[0]
+            return user.scalars().first()
+
+    @classmethod
+    async def get_users_by_ids(cls, ids: list):
+        async with async_session() as session:
+            users = (
+                select(UsersAccounts)
+                .options(*PROFILE_LOAD_OPTIONS)
+                .filter(UsersAccounts.id.in_(ids))
+            )
+            users = await session.execute(users)
+            return users.scalars().all()
 
     @classmethod
     async def update_user_profile(cls, _id, values_to_update, flag):
         async with async_session() as session:
             if flag:
-                city = await session.execute(
-                    select(Cities.id).filter(Cities.name == values_to_update.get("city"))
-                )
-                city = city.scalar()
-                values_to_update["city_id"] = city
+                values_to_update["city_id"] = GeoIndex.city_id(values_to_update.get("city"))
                 del values_to_update["city"]
             del flag
             statement = (
@@ -83,25 +166,56 @@ class DatabaseInterface:
             )
             await session.execute(statement)
             await session.commit()
+        await ProfileCache.invalidate(_id)
 
     @classmethod
     async def delete_user(cls, _id):
         async with async_session() as session:
-            statement = delete(UsersAccounts).filter(UsersAccounts.id == _id)
-            await session.execute(statement)
+            await cls._release_account_media(session, _id)
+            statement = (
+                delete(UsersAccounts).filter(UsersAccounts.id == _id)
+                .returning(UsersAccounts.username)
+            )
+            username = await session.execute(statement)
+            username = username.scalar()
+            session.add(OutboxMessages(**outbox_message(DropUser(userId=str(_id)), "notification")))
             await session.commit()
+        await ProfileCache.invalidate(_id)
+        if username is not None:
+            await UsernameFilter.remove(username)
 
     @classmethod
-    async def add_new_avatar(cls, file_name, _id):
+    async def add_new_avatar(cls, avatar: StagedAvatar, _id):
+        file_names = avatar.file_names
         async with async_session() as session:
-            media_url = CloudMediaStorageAdapter.get_media_prefix(file_name, avatar=True)
+            await cls._acquire_media(
+                session, Buckets.avatars.value, list(file_names.values()), avatar.store
+            )
+            urls = {
+                name: CloudMediaStorageAdapter.get_media_prefix(file_name, avatar=True)
+                for name, file_name in file_names.items()
+            }
+            media_url = urls["original"]
             new_avatar = UsersAvatars(
                 accountId=_id,
-                mediaUrl=media_url
+                mediaUrl=media_url,
+                thumbnailUrl=urls.get("thumbnail"),
+                mediumUrl=urls.get("medium")
+            )
+            message = UpdateAvatar(
+                target="avatar",
+                userId=str(_id),
+                newMediaUrl=media_url
+            )
+            session.add_all(
+                [
+                    new_avatar,
+                    OutboxMessages(**outbox_message(message, "notification", f"{_id}:avatar"))
+                ]
             )
-            session.add(new_avatar)
             await session.commit()
-            return media_url
+        await ProfileCache.invalidate(_id)
+        return urls
 
     @classmethod
     async def delete_avatar(cls, avatar_id, org_id):
@@ -109,54 +223,197 @@ class DatabaseInterface:
             statement = delete(UsersAvatars).filter(
                 UsersAvatars.id == avatar_id,
                 UsersAvatars.accountId == org_id
-            ).returning(UsersAvatars.mediaUrl)
-            link = await session.execute(statement)
-            link = link.scalar()
-            await session.execute(statement)
+            ).returning(UsersAvatars.mediaUrl, UsersAvatars.thumbnailUrl, UsersAvatars.mediumUrl)
+            links = await session.execute(statement)
+            links = links.first()
+            link = None if links is None else links.mediaUrl
             query = (
                 select(UsersAvatars.mediaUrl).filter(UsersAvatars.accountId == org_id)
                 .order_by(UsersAvatars.created_at.desc())
             )
             new_link = await session.execute(query)
-            new_link = new_link.scalars().first()
-            try:
-                CloudMediaStorageAdapter.delete_avatar(link)
-            except IndexError:
-                pass
-            finally:
-                await session.commit()
-            return new_link
+            new_link = new_link.scalars().first() or CloudMediaStorageAdapter.get_default_avatar()
+            if link is not None:
+                message = UpdateAvatar(
+                    target="avatar",
+                    userId=str(org_id),
+                    newMediaUrl=new_link
+                )
+                session.add(
+                    OutboxMessages(**outbox_message(message, "notification", f"{org_id}:avatar"))
+                )
+                await cls._release_media(
+                    session, Buckets.avatars.value,
+                    [
+                        CloudMediaStorageAdapter.get_media_key(url, avatar=True)
+                        for url in links if url is not None
+                    ]
+                )
+            await session.commit()
+        await ProfileCache.invalidate(org_id)
+        return new_link
 
     @classmethod
-    async def update_back_pad(cls, file_name, _id):
+    async def update_back_pad(cls, back_pad: StagedUpload, _id):
         async with async_session() as session:
             old_link = (
                 select(UsersBackPads.mediaUrl)
                 .filter(UsersBackPads.accountId == _id)
+                .with_for_update()
             )
             old_link = await session.execute(old_link)
             old_link = old_link.scalar()
-            CloudMediaStorageAdapter.delete_back_pad(old_link)
-            media_url = CloudMediaStorageAdapter.get_media_prefix(file_name, back_pad=True)
+            media_url = CloudMediaStorageAdapter.get_media_prefix(back_pad.key, back_pad=True)
+            if old_link == media_url:
+                return media_url
+            await cls._acquire_media(session, Buckets.back_pads.value, [back_pad.key], back_pad.store)
             new_back_pad = (
                 update(UsersBackPads)
                 .filter(UsersBackPads.accountId == _id)
                 .values(mediaUrl=media_url)
             )
             await session.execute(new_back_pad)
+            if old_link is not None:
+                await cls._release_media(
+                    session, Buckets.back_pads.value,
+                    [CloudMediaStorageAdapter.get_media_key(old_link, back_pad=True)]
+                )
             await session.commit()
-            return media_url
+        await ProfileCache.invalidate(_id)
+        return media_url
 
     @classmethod
-    async def drop_user(cls, _id):
+    async def _release_account_media(cls, session, _id):
+        """Снимает ссылки на медиа аккаунта перед его удалением (строки удалятся каскадом)"""
+        avatars = await session.execute(
+            select(UsersAvatars.mediaUrl, UsersAvatars.thumbnailUrl, UsersAvatars.mediumUrl)
+            .filter(UsersAvatars.accountId == _id)
+        )
+        await cls._release_media(
+            session, Buckets.avatars.value,
+            [
+                CloudMediaStorageAdapter.get_media_key(url, avatar=True)
+                for row in avatars for url in row if url is not None
+            ]
+        )
+        back_pads = await session.execute(
+            select(UsersBackPads.mediaUrl).filter(UsersBackPads.accountId == _id)
+        )
+        await cls._release_media(
+            session, Buckets.back_pads.value,
+            [
+                CloudMediaStorageAdapter.get_media_key(url, back_pad=True)
+                for url in back_pads.scalars()
+            ]
+        )
+
+    @staticmethod
+    async def existing_media(bucket: str, keys: list[str]) -> set[str]:
         async with async_session() as session:
+            rows = await session.execute(
+                select(MediaObjects.key)
+                .filter(MediaObjects.bucket == bucket, MediaObjects.key.in_(keys))
+            )
+            return set(rows.scalars().all())
+
+    @staticmethod
+    async def _acquire_media(session, bucket: str, keys: list[str], store):
+        """
+        Добавляет ссылку на объекты с ключами keys
+
+        Объекты, на которые раньше никто не ссылался, записываются через
+        store(keys) до коммита, пока строки media_objects заблокированы:
+        одновременная загрузка того же содержимого ждет, а не ссылается на
+        еще не записанный объект, а MediaReaper не удалит его.
+
+        Строки вставляются и блокируются по возрастанию ключа: при другом
+        порядке две загрузки с пересекающимися ключами могли бы взаимно
+        заблокироваться.
+        """
+        if not keys:
+            return
+        statement = (
+            pg_insert(MediaObjects)
+            .values([{"bucket": bucket, "key": key, "refcount": 1} for key in sorted(set(keys))])
+            .on_conflict_do_update(
+                index_elements=[MediaObjects.bucket, MediaObjects.key],
+                set_={"refcount": MediaObjects.refcount + 1, "released_at": None}
+            )
+            .returning(MediaObjects.key, MediaObjects.refcount)
+        )
+        rows = await session.execute(statement)
+        fresh = [row.key for row in rows if row.refcount == 1]
+        if fresh:
+            await store(fresh)
+
+    @staticmethod
+    async def _release_media(session, bucket: str, keys: list[str]):
+        """
+        Снимает по ссылке на каждый ключ
+
+        Объекты без ссылок помечаются released_at и удаляются позже
+        MediaReaper. Ключи, которых нет в media_objects, остались от
+        именования до адресации по содержимому и принадлежали только этой
+        записи, они помечаются так же.
+        """
+        keys = [key for key in keys if key not in DEFAULT_KEYS]
+        if not keys:
+            return
+        now = datetime.datetime.utcnow()
+        counts = collections.Counter(keys)
+        # UPDATE блокирует строки в порядке обхода, поэтому сначала строки
+        # блокируются явно по возрастанию ключа, как в _acquire_media
+        await session.execute(
+            select(MediaObjects.key)
+            .filter(MediaObjects.bucket == bucket, MediaObjects.key.in_(sorted(counts)))
+            .order_by(MediaObjects.key)
+            .with_for_update()
+        )
+        tracked = set()
+        for decrement in sorted(set(counts.values())):
+            rows = await session.execute(
+                update(MediaObjects)
+                .filter(
+                    MediaObjects.bucket == bucket,
+                    MediaObjects.key.in_(sorted(key for key, count in counts.items() if count == decrement))
+                )
+                .values(
+                    refcount=MediaObjects.refcount - decrement,
+                    released_at=case((MediaObjects.refcount - decrement <= 0, now), else_=None)
+                )
+                .returning(MediaObjects.key)
+            )
+            tracked.update(rows.scalars())
+        untracked = sorted(key for key in counts if key not in tracked)
+        if untracked:
             await session.execute(
+                pg_insert(MediaObjects)
+                .values([
+                    {"bucket": bucket, "key": key, "refcount": 0, "released_at": now}
+                    for key in untracked
+                ])
+                .on_conflict_do_nothing()
+            )
+
+    @classmethod
+    async def drop_user(cls, _id):
+        async with async_session() as session:
+            await cls._release_account_media(session, _id)
+            username = await session.execute(
                 delete(UsersAccounts).filter(UsersAccounts.id == _id)
+                .returning(UsersAccounts.username)
             )
+            username = username.scalar()
+            session.add(OutboxMessages(**outbox_message(DropUser(userId=str(_id)), "notification")))
             await session.commit()
+        await ProfileCache.invalidate(_id)
+        if username is not None:
+            await UsernameFilter.remove(username)
 
     @classmethod
     async def check_username(cls, username):
+        if not await UsernameFilter.might_contain(username):
+            return True
         async with async_session() as session:
             username_is_existed = (select(UsersAccounts.id)
                                    .filter(UsersAccounts.username == username))
@@ -169,43 +426,38 @@ class DatabaseInterface:
 
     @classmethod
     async def update_statistic(cls, user_id, field, increase):
+        await cls.apply_statistic_deltas(
+            {user_id: {field: 1 if increase else -1}}
+        )
+
+    @classmethod
+    async def apply_statistic_deltas(cls, changes: dict):
+        """
+        Применение изменений статистики одним пакетным запросом
+
+        :param changes: {user_id: {"events": delta, "friends": delta}}
+        """
+        rows = [
+            {
+                "_account_id": user_id,
+                "_events": deltas.get("events", 0),
+                "_friends": deltas.get("friends", 0),
+            }
+            for user_id, deltas in changes.items()
+        ]
+        if not rows:
+            return
+        table = AccountStatistic.__table__
+        statement = (
+            update(table)
+            .where(table.c.accountId == bindparam("_account_id"))
+            .values(
+                totalEvents=table.c.totalEvents + bindparam("_events"),
+                totalFriends=table.c.totalFriends + bindparam("_friends"),
+            )
+        )
         async with async_session() as session:
-            if field == "events":
-                current_value = (select(
-                    AccountStatistic.totalEvents)
-                    .filter(AccountStatistic.accountId == user_id)
-                )
-                current_value = await session.execute(current_value)
-                current_value = current_value.scalar()
-                if increase:
-                    await session.execute(
-                        update(AccountStatistic).values(
-                            totalEvents=current_value + 1
-                        ).filter(AccountStatistic.accountId == user_id)
-                    )
-                else:
-                    await session.execute(
-                        update(AccountStatistic).values(
-                            totalEvents=current_value - 1
-                        ).filter(AccountStatistic.accountId == user_id)
-                    )
-            elif field == "friends":
-                current_value = (
-                    select(AccountStatistic.totalFriends)
-                    .filter(AccountStatistic.accountId == user_id)
-                )
-                current_value = await session.execute(current_value)
-                current_value = current_value.scalar()
-                if increase:
-                    await session.execute(
-                        update(AccountStatistic).values(
-                            totalFriends=current_value + 1
-                        ).filter(AccountStatistic.accountId == user_id)
-                    )
-                else:
-                    await session.execute(
-                        update(AccountStatistic).values(
-                            totalFriends=current_value - 1
-                        ).filter(AccountStatistic.accountId == user_id)
-                    )
+            connection = await session.connection()
+            await connection.execute(statement, rows)
             await session.commit()
+        await ProfileCache.invalidate(*changes)
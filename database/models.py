@@ -5,7 +5,7 @@ from uuid import UUID
 
 import pandas as pd
 import sqlalchemy.orm
-from sqlalchemy import String, ForeignKey, Table, MetaData, BigInteger
+from sqlalchemy import String, ForeignKey, Table, MetaData, BigInteger, text
 from sqlalchemy.orm import Mapped, mapped_column, relationship, DeclarativeBase
 import enum
 
@@ -198,6 +198,9 @@ class UsersAvatars(Media, Base):
     """Таблица аватаров пользователей"""
     __tablename__ = "users_avatars"
 
+    # mediaUrl - исходный размер, у аватаров до обработки версий нет
+    thumbnailUrl: Mapped[str | None]
+    mediumUrl: Mapped[str | None]
     accountId: Mapped[UUID] = mapped_column(ForeignKey("users_accounts.id", ondelete="CASCADE"))
 
     account: Mapped["UsersAccounts"] = relationship(
@@ -230,9 +233,41 @@ class AccountStatistic(Base):
     )
 
 
+class OutboxMessages(Base):
+    """Таблица исходящих сообщений, пишется в одной транзакции с изменениями"""
+    __tablename__ = "outbox_messages"
+
+    id: Mapped[intpk]
+    queue: Mapped[str]
+    payload: Mapped[str]
+    coalesce_key: Mapped[str | None] = mapped_column(index=True)
+    created_at: Mapped[created_at]
+
+
+class MediaObjects(Base):
+    """Объекты S3 с ключом по содержимому и число записей, ссылающихся на них"""
+    __tablename__ = "media_objects"
+
+    bucket: Mapped[str] = mapped_column(primary_key=True)
+    key: Mapped[str] = mapped_column(primary_key=True)
+    refcount: Mapped[int] = mapped_column(default=1)
+    # Время, когда на объект перестали ссылаться, такие объекты удаляет MediaReaper
+    released_at: Mapped[datetime.datetime | None] = mapped_column(index=True)
+    created_at: Mapped[created_at]
+
+
+# Колонки, добавленные в существующие таблицы: create_all их не создает
+SCHEMA_UPGRADES = (
+    'ALTER TABLE users_avatars ADD COLUMN IF NOT EXISTS "thumbnailUrl" VARCHAR',
+    'ALTER TABLE users_avatars ADD COLUMN IF NOT EXISTS "mediumUrl" VARCHAR',
+)
+
+
 async def create_tables():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        for statement in SCHEMA_UPGRADES:
+            await conn.execute(text(statement))
 
     data = pd.read_sql("select count(*) from federal_districts", sync_engine)
     if data.empty:
@@ -59,6 +59,13 @@ class City(BaseView):
     name: str
 
 
+class CityInfo(BaseView):
+    id: int
+    name: str
+    region: str | None
+    federal_district: str | None
+
+
 class UserProfile(BaseView):
     firstName: str
     lastName: str
@@ -74,7 +81,8 @@ class Media(BaseView):
 
 
 class UsersAvatars(Media):
-    pass
+    thumbnailUrl: str | None = None
+    mediumUrl: str | None = None
 
 
 class UsersBackPads(Media):
@@ -95,6 +103,28 @@ class UserView(BaseView):
     accountStatistic: UsersAccountStatistic
 
 
+class UploadConfirm(BaseModel):
+    key: str = Field(max_length=200)
+
+
+class UsersBatchRequest(BaseModel):
+    ids: list[uuid.UUID] = Field(
+        min_length=1,
+        max_length=300
+    )
+
+
+class StatisticField(str, enum.Enum):
+    events = "events"
+    friends = "friends"
+
+
+class StatisticDelta(BaseModel):
+    user_id: uuid.UUID
+    field: StatisticField
+    delta: int
+
+
 class UpdateUsersView(BaseModel):
     username: str | None = None
     firstName: str = None
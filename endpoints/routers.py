@@ -1,23 +1,31 @@
-import asyncio
 import logging
 import random
 from uuid import UUID
 
 from sqlalchemy.exc import SQLAlchemyError as Error
-from fastapi import APIRouter, HTTPException, Depends, File, BackgroundTasks, Body, Request
-from fastapi.responses import JSONResponse
-from fastapi_cache.decorator import cache
+from fastapi import APIRouter, HTTPException, Depends, Body, Request, Query
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
 
+from config import settings
 from cross_sec import header_controller
 from database.interface import DatabaseInterface
-from endpoints.dto import UserCreateModel, UserView, UpdateUsersView, TokenData, EmailSenderData, \
-    FirebaseToken, AppendDevice, UpdateAvatar
-from helpers.cloud_storage import AvatarsUploader, BackPadsUploader
+from endpoints.dto import UserCreateModel, UserView, UpdateUsersView, TokenData, \
+    FirebaseToken, AppendDevice, UsersBatchRequest, StatisticField, StatisticDelta, \
+    CityInfo, UploadConfirm
+from helpers.cache import ProfileCache
+from helpers.cloud_storage import BackPadsUploader, Buckets, CloudMediaStorageAdapter, StagedAvatar
 from helpers.cross_service import CrossService
 from helpers.decorators import router_decorator
-from helpers.publisher import publish_message
-from helpers.security import Authenticator
-from messages.notifications import DropUser
+from helpers.geo import GeoIndex
+from helpers.images import ImageProcessor
+from helpers.media_gc import MediaReaper
+from helpers.outbox import OutboxRelay
+from helpers.publisher import Publisher
+from helpers.registration import CommunityRegistrations
+from helpers.security import Authenticator, Hasher
+from helpers.statistic import StatisticAggregator
+from helpers.uploads import read_file, stream_file
 
 profile = APIRouter(prefix="/profile", dependencies=[Depends(header_controller)])
 logger = logging.getLogger(__name__)
@@ -41,44 +49,15 @@ async def check_available_username(request: Request, username: str):
 
 
 @profile.post("/", status_code=201)
-async def create_user(request: Request, body: UserCreateModel, bg_tasks: BackgroundTasks):
+async def create_user(request: Request, body: UserCreateModel):
     """Создание пользователя"""
-    async def send_email(data: EmailSenderData):
-        await publish_message(data, "email")
-
-    async def add_token(data: FirebaseToken):
-        await publish_message(data, "notification")
-
-    async def send_request_to_community(_id: str, user: UserCreateModel):
-        await CrossService.add_user(_id, user)
-
-    async def background_tasks(
-            _email_data: EmailSenderData, _token_data: FirebaseToken,
-            _id: str, user: UserCreateModel
-    ):
-        await asyncio.gather(
-            send_email(_email_data), add_token(_token_data),
-            send_request_to_community(_id, user)
-        )
-
     @router_decorator(request)
     async def _create_user():
-        user_id, link = await DatabaseInterface.create_user(body)
         verification_code = random.randint(10000, 100000)
-        email_data = EmailSenderData(
-            email=body.email,
-            target="verification",
-            verification_code=str(verification_code)
-        )
-        token_data = FirebaseToken(
-            target="token",
-            firebaseToken=body.firebaseToken,
-            username=body.username,
-            userId=str(user_id),
-            mediaUrl=link
-        )
-        bg_tasks.add_task(background_tasks, email_data, token_data,
-                          str(user_id), body)
+        # Письмо и firebase token уходят через outbox вместе с созданием
+        user_id, link = await DatabaseInterface.create_user(body, verification_code)
+        # Регистрация в community уходит пачкой, при заполненной очереди ждем
+        await CommunityRegistrations.submit(str(user_id), body)
         if isinstance(user_id, UUID):
             return JSONResponse(
                 content={
@@ -95,7 +74,6 @@ async def create_user(request: Request, body: UserCreateModel, bg_tasks: Backgro
 
 
 @profile.get("/", response_model=UserView)
-@cache(expire=30)
 async def get_user_profile(
         request: Request,
         user: TokenData = Depends(Authenticator.get_user_by_token)
@@ -103,9 +81,10 @@ async def get_user_profile(
     """Получение информации о пользователе"""
     @router_decorator(request)
     async def _get_user_profile(_user):
-        _id = _user.id
-        _user = await DatabaseInterface.get_user_by_id(_id)
-        return UserView.model_validate(_user)
+        content = await ProfileCache.get_or_load(_user.id, DatabaseInterface.get_user_by_id)
+        if content is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        return Response(content=content, media_type="application/json")
 
     return await _get_user_profile(user)
 
@@ -139,7 +118,6 @@ async def update_user_profile(
 
 @profile.delete("/", status_code=200)
 async def delete_user_profile(
-        bg_tasks: BackgroundTasks,
         request: Request,
         user: TokenData = Depends(Authenticator.get_user_by_token)
 ):
@@ -149,10 +127,6 @@ async def delete_user_profile(
     @router_decorator(request)
     async def _delete_user_profile():
         await DatabaseInterface.delete_user(_id)
-        data = DropUser(
-            userId=_id
-        )
-        bg_tasks.add_task(publish_message, data, "notification")
         return JSONResponse(
             {
                 "statusCode": 200,
@@ -161,60 +135,109 @@ async def delete_user_profile(
             200
         )
 
+    return await _delete_user_profile()
+
+
+def _file_upload_schema(field_name: str) -> dict:
+    """Описание multipart-тела для OpenAPI, файл читается из запроса потоково"""
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {
+                "multipart/form-data": {
+                    "schema": {
+                        "type": "object",
+                        "required": [field_name],
+                        "properties": {field_name: {"type": "string", "format": "binary"}},
+                    }
+                }
+            },
+        }
+    }
+
+
+async def _save_avatar(avatar: StagedAvatar, _id) -> dict[str, str]:
+    # Новое содержимое проверяется и записывается до транзакции, уже
+    # загруженное ранее не рендерится и не загружается повторно
+    existing = await DatabaseInterface.existing_media(
+        Buckets.avatars.value, list(avatar.file_names.values())
+    )
+    await avatar.store([key for key in avatar.file_names.values() if key not in existing])
+    return await DatabaseInterface.add_new_avatar(avatar, _id)
+
+
+def _avatar_response(links: dict[str, str]) -> JSONResponse:
+    return JSONResponse(
+        status_code=200,
+        content={
+            "statusCode": 200,
+            "status": "success",
+            "link": links["original"],
+            "renditions": links
+        }
+    )
 
-@profile.post("/avatar")
+
+@profile.post("/avatar", openapi_extra=_file_upload_schema("avatar"))
 async def add_users_avatars(
-        bg_tasks: BackgroundTasks,
         request: Request,
-        avatar: bytes = File(...),
-        user: TokenData = Depends(get_user_profile)
+        user: TokenData = Depends(Authenticator.get_user_by_token)
 ):
     """Добавление аватара пользователя"""
     _id = user.id
 
     @router_decorator(request)
     async def _add_users_avatars():
-        file_name = f"{_id}-avatar-{random.randint(10000, 999999)}.png"
-        AvatarsUploader.upload_avatar(avatar, file_name)
-        link = await DatabaseInterface.add_new_avatar(file_name, _id)
-        data = UpdateAvatar(
-            target="avatar",
-            userId=str(_id),
-            newMediaUrl=link
-        )
-        bg_tasks.add_task(publish_message, data, "notification")
-        return JSONResponse(
-            status_code=200,
-            content={
-                "statusCode": 200,
-                "status": "success",
-                "link": link
-            }
-        )
+        # Изображение нужно декодировать целиком, размер ограничен UPLOAD_MAX_SIZE
+        avatar = StagedAvatar(await read_file(request, "avatar", settings.UPLOAD_MAX_SIZE))
+        return _avatar_response(await _save_avatar(avatar, _id))
 
     return await _add_users_avatars()
 
 
+@profile.post("/avatar/upload-url")
+async def get_avatar_upload_url(
+        request: Request,
+        user: TokenData = Depends(Authenticator.get_user_by_token)
+):
+    """Подписанная форма для загрузки аватара напрямую в хранилище"""
+    @router_decorator(request)
+    async def _get_avatar_upload_url():
+        return await CloudMediaStorageAdapter.presign_upload(Buckets.avatars.value, user.id)
+
+    return await _get_avatar_upload_url()
+
+
+@profile.post("/avatar/confirm")
+async def confirm_avatar_upload(
+        request: Request,
+        body: UploadConfirm,
+        user: TokenData = Depends(Authenticator.get_user_by_token)
+):
+    """Сохранение аватара, загруженного по подписанной форме"""
+    @router_decorator(request)
+    async def _confirm_avatar_upload():
+        bucket = Buckets.avatars.value
+        await CloudMediaStorageAdapter.check_upload(bucket, body.key, user.id)
+        try:
+            avatar = StagedAvatar(await CloudMediaStorageAdapter.read_object(bucket, body.key))
+            links = await _save_avatar(avatar, user.id)
+        finally:
+            await CloudMediaStorageAdapter.delete_media(bucket, [body.key])
+        return _avatar_response(links)
+
+    return await _confirm_avatar_upload()
+
+
 @profile.delete("/avatar/{avatar_id}")
 async def delete_avatar(
-        bg_task: BackgroundTasks, avatar_id: int, request: Request,
+        avatar_id: int, request: Request,
         user: TokenData = Depends(Authenticator.get_user_by_token)
 ):
     """Удаление аватара пользователя"""
     @router_decorator(request)
     async def _delete_avatar():
-        _id = user.id
-
-        async def delete_process(_avatar_id, org_id):
-            prev_avatar = await DatabaseInterface.delete_avatar(_avatar_id, org_id)
-            data = UpdateAvatar(
-                target="avatar",
-                userId=str(_id),
-                newMediaUrl=prev_avatar
-            )
-            await publish_message(data, "notification")
-
-        bg_task.add_task(delete_process, avatar_id, _id)
+        await DatabaseInterface.delete_avatar(avatar_id, user.id)
         return JSONResponse(
             status_code=200,
             content={
@@ -226,43 +249,79 @@ async def delete_avatar(
     return await _delete_avatar()
 
 
-@profile.post("/back_pad")
+def _back_pad_response(link: str) -> JSONResponse:
+    return JSONResponse(
+        status_code=200,
+        content={
+            "statusCode": 200,
+            "status": "success",
+            "link": link
+        }
+    )
+
+
+@profile.post("/back_pad", openapi_extra=_file_upload_schema("back_pad"))
 async def add_users_back_pad(
-        bg_tasks: BackgroundTasks,
         request: Request,
-        back_pad: bytes = File(...),
         user: TokenData = Depends(Authenticator.get_user_by_token)
 ):
     """Замена подложки профиля"""
     @router_decorator(request)
     async def _add_users_back_pad():
         _id = user.id
-        file_name = f"{_id}-back_pad.png"
-        BackPadsUploader.upload_back_pads(back_pad, file_name)
-        link = await DatabaseInterface.update_back_pad(file_name, _id)
-        return JSONResponse(
-            status_code=200,
-            content={
-                "statusCode": 200,
-                "status": "success",
-                "link": link
-            }
+        back_pad = await BackPadsUploader.upload_back_pads(
+            stream_file(request, "back_pad", settings.UPLOAD_MAX_SIZE)
         )
+        try:
+            link = await DatabaseInterface.update_back_pad(back_pad, _id)
+        finally:
+            await back_pad.discard()
+        return _back_pad_response(link)
 
     return await _add_users_back_pad()
 
 
+@profile.post("/back_pad/upload-url")
+async def get_back_pad_upload_url(
+        request: Request,
+        user: TokenData = Depends(Authenticator.get_user_by_token)
+):
+    """Подписанная форма для загрузки подложки напрямую в хранилище"""
+    @router_decorator(request)
+    async def _get_back_pad_upload_url():
+        return await CloudMediaStorageAdapter.presign_upload(Buckets.back_pads.value, user.id)
+
+    return await _get_back_pad_upload_url()
+
+
+@profile.post("/back_pad/confirm")
+async def confirm_back_pad_upload(
+        request: Request,
+        body: UploadConfirm,
+        user: TokenData = Depends(Authenticator.get_user_by_token)
+):
+    """Сохранение подложки, загруженной по подписанной форме"""
+    @router_decorator(request)
+    async def _confirm_back_pad_upload():
+        bucket = Buckets.back_pads.value
+        await CloudMediaStorageAdapter.check_upload(bucket, body.key, user.id)
+        back_pad = await CloudMediaStorageAdapter.stage_object(bucket, body.key, suffix=".png")
+        try:
+            link = await DatabaseInterface.update_back_pad(back_pad, user.id)
+        finally:
+            await back_pad.discard()
+        return _back_pad_response(link)
+
+    return await _confirm_back_pad_upload()
+
+
 @profile.delete("/drop/{_id}", status_code=200)
-async def drop_unverified_user(_id, request: Request, bg_tasks: BackgroundTasks):
+async def drop_unverified_user(_id, request: Request):
     """Удаление неподтвержденного пользователя"""
 
     @router_decorator(request)
     async def _delete_unverified_user():
         await DatabaseInterface.drop_user(_id)
-        data = DropUser(
-            userId=_id
-        )
-        bg_tasks.add_task(publish_message, data)
 
     return await _delete_unverified_user()
 
@@ -271,7 +330,6 @@ async def drop_unverified_user(_id, request: Request, bg_tasks: BackgroundTasks)
 async def add_fire_base_token(
         token: AppendDevice,
         request: Request,
-        bg_task: BackgroundTasks,
         user: TokenData = Depends(Authenticator.get_user_by_token)
 ):
     """Firebase token для пользователя"""
@@ -284,7 +342,11 @@ async def add_fire_base_token(
             username=user.username,
             firebaseToken=token.token
         )
-        bg_task.add_task(publish_message, data, "notification")
+        # Повторные регистрации того же токена схлопываются, токены разных
+        # устройств пользователя отправляются все
+        await DatabaseInterface.enqueue_message(
+            data, "notification", f"{_id}:token:{token.token}"
+        )
         return JSONResponse(
             {
                 "statusCode": 200,
@@ -300,25 +362,103 @@ service = APIRouter(prefix="/profile", dependencies=[Depends(header_controller)]
 
 
 @service.get("/{_id}", response_model=UserView)
-@cache(expire=30)
 async def user_profile(
-        _id: str,
+        _id: UUID,
         request: Request,
 ):
     """Получение информации о пользователе"""
     @router_decorator(request)
     async def _user_profile():
-        user = await DatabaseInterface.get_user_by_id(_id)
-        return UserView.model_validate(user)
+        content = await ProfileCache.get_or_load(_id, DatabaseInterface.get_user_by_id)
+        if content is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        return Response(content=content, media_type="application/json")
 
     return await _user_profile()
 
 
+@service.post("/batch", response_model=list[UserView])
+async def users_profiles(body: UsersBatchRequest, request: Request):
+    """Получение информации о нескольких пользователях"""
+    @router_decorator(request)
+    async def _users_profiles():
+        ids = list(dict.fromkeys(body.ids))
+        users = await ProfileCache.get_many_or_load(ids, DatabaseInterface.get_users_by_ids)
+        return Response(content=b"[" + b",".join(users) + b"]", media_type="application/json")
+
+    return await _users_profiles()
+
+
 @service.patch("/", status_code=202)
-async def update_statistic(user_id: str, field: str, request: Request, increase: bool = True):
+async def update_statistic(
+        user_id: UUID, field: StatisticField, request: Request, increase: bool = True
+):
     """Обновление статистики пользователя"""
     @router_decorator(request)
     async def _update_statistic():
-        await DatabaseInterface.update_statistic(user_id, field, increase)
+        await StatisticAggregator.add(
+            [(str(user_id), field.value, 1 if increase else -1)]
+        )
 
     return await _update_statistic()
+
+
+@service.post("/statistic", status_code=202)
+async def update_statistic_batch(body: list[StatisticDelta], request: Request):
+    """Пакетное обновление статистики пользователей"""
+    @router_decorator(request)
+    async def _update_statistic_batch():
+        await StatisticAggregator.add(
+            [(str(item.user_id), item.field.value, item.delta) for item in body]
+        )
+
+    return await _update_statistic_batch()
+
+
+# Справочные данные, отдаются из памяти процесса
+reference = APIRouter(prefix="/reference", dependencies=[Depends(header_controller)])
+
+
+@reference.get("/cities", response_model=list[CityInfo])
+async def cities(
+        request: Request,
+        prefix: str | None = None,
+        limit: int = Query(10, ge=1, le=50)
+):
+    """Справочник городов и автодополнение по началу названия"""
+    @router_decorator(request)
+    async def _cities():
+        headers = {
+            "ETag": GeoIndex.etag,
+            "Cache-Control": "public, max-age=86400"
+        }
+        if request.headers.get("if-none-match") == GeoIndex.etag:
+            return Response(status_code=304, headers=headers)
+        items = GeoIndex.search(prefix, limit) if prefix else GeoIndex.cities()
+        return JSONResponse(
+            content=jsonable_encoder([CityInfo.model_validate(item) for item in items]),
+            headers=headers
+        )
+
+    return await _cities()
+
+
+# Внутренние показатели воркера
+monitoring = APIRouter(dependencies=[Depends(header_controller)])
+
+
+@monitoring.get("/stats")
+async def stats():
+    """Счетчики компонентов текущего воркера"""
+    return {
+        "hasher": Hasher.stats(),
+        "token_cache": Authenticator.stats(),
+        "profile_cache": ProfileCache.stats(),
+        "publisher": Publisher.stats(),
+        "outbox": OutboxRelay.stats(),
+        "downstreams": CrossService.stats(),
+        "community_registrations": CommunityRegistrations.stats(),
+        "storage": CloudMediaStorageAdapter.stats(),
+        "images": ImageProcessor.stats(),
+        "media_gc": MediaReaper.stats(),
+    }
@@ -0,0 +1,350 @@
+import asyncio
+import contextlib
+import logging
+import uuid
+
+from fastapi_cache import FastAPICache
+
+from config import settings
+from endpoints.dto import UserView
+from helpers.lru import TTLCache
+from helpers.metrics import PROFILE_CACHE_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+# Запись профиля, только если поколение id не изменилось с начала загрузки
+STORE_IF_GENERATION = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[2] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[3])
+return 1
+"""
+# Снятие блокировки загрузки, только если ее держит эта загрузка
+RELEASE_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class ProfileCache:
+
+    """
+    Двухуровневый кэш профилей пользователей, ключ - id аккаунта
+
+    Первый уровень - LRU в памяти воркера, второй - Redis. Оба хранят готовый
+    JSON ответа, поэтому попадание не требует валидации pydantic. Каждая
+    запись в DatabaseInterface, меняющая профиль, сбрасывает запись в Redis и
+    рассылает id через pub/sub, чтобы все воркеры сбросили локальные копии.
+
+    Промахи загружаются из БД не более одного раза на id: внутри воркера
+    запросы ждут общий future, между воркерами - блокировку в Redis. Запись в
+    Redis живет еще PROFILE_CACHE_STALE секунд после устаревания: такая запись
+    отдается сразу, а обновляется одной фоновой задачей.
+
+    invalidate() увеличивает поколение id. Загрузка запоминает поколение до
+    запроса в БД и записывает результат, только если оно не изменилось:
+    иначе загрузка, начатая до записи, вернула бы в кэш старый профиль.
+    """
+
+    _namespace = "profile"
+    _channel = "profile-invalidation"
+    _expire = settings.PROFILE_CACHE_EXPIRE
+    _stale = settings.PROFILE_CACHE_STALE
+    _lock_timeout = settings.PROFILE_LOCK_TIMEOUT
+    _local = TTLCache(maxsize=settings.PROFILE_LOCAL_CACHE_SIZE, ttl=settings.PROFILE_LOCAL_CACHE_TTL)
+    _inflight: dict[str, asyncio.Future] = {}
+    _refreshing: set[str] = set()
+    _tasks: set[asyncio.Task] = set()
+    _stats = {"redis_hits": 0, "redis_misses": 0, "stale_served": 0, "coalesced": 0,
+              "loads": 0, "stale_loads": 0, "refresh_errors": 0}
+    _listener: asyncio.Task | None = None
+
+    @classmethod
+    def _key(cls, _id) -> str:
+        return f"{FastAPICache.get_prefix()}:{cls._namespace}:{_id}"
+
+    @classmethod
+    def _lock_key(cls, _id) -> str:
+        return f"{cls._key(_id)}:lock"
+
+    @classmethod
+    def _generation_key(cls, _id) -> str:
+        return f"{cls._key(_id)}:generation"
+
+    @classmethod
+    async def _generations(cls, ids: list) -> list[str]:
+        values = await cls._redis().mget([cls._generation_key(_id) for _id in ids])
+        return [value or "0" for value in values]
+
+    @staticmethod
+    def _canonical(ids) -> list[uuid.UUID]:
+        """id в виде UUID, чтобы ключи кэша совпадали с str(user.id) из БД"""
+        return [_id if isinstance(_id, uuid.UUID) else uuid.UUID(str(_id)) for _id in ids]
+
+    @classmethod
+    def _redis(cls):
+        return FastAPICache.get_backend().redis
+
+    @staticmethod
+    def render(user) -> bytes:
+        return UserView.model_validate(user).model_dump_json().encode()
+
+    @classmethod
+    async def get_many(cls, ids: list) -> tuple[dict[str, bytes], list]:
+        """Возвращает найденные профили и список id устаревших записей"""
+        found = {}
+        stale = []
+        remote = []
+        for _id in ids:
+            value = cls._local.get(str(_id))
+            if value is None:
+                remote.append(_id)
+            else:
+                found[str(_id)] = value
+        if found:
+            PROFILE_CACHE_LOOKUPS.labels("local_hit").inc(len(found))
+        if not remote:
+            return found, stale
+        async with cls._redis().pipeline(transaction=False) as pipe:
+            for _id in remote:
+                pipe.get(cls._key(_id))
+                pipe.pttl(cls._key(_id))
+            values = await pipe.execute()
+        for _id, value, ttl in zip(remote, values[::2], values[1::2]):
+            if value is None:
+                cls._stats["redis_misses"] += 1
+                PROFILE_CACHE_LOOKUPS.labels("miss").inc()
+                continue
+            cls._stats["redis_hits"] += 1
+            value = value.encode()
+            found[str(_id)] = value
+            if 0 <= ttl <= cls._stale * 1000:
+                cls._stats["stale_served"] += 1
+                PROFILE_CACHE_LOOKUPS.labels("stale_hit").inc()
+                stale.append(_id)
+            else:
+                PROFILE_CACHE_LOOKUPS.labels("redis_hit").inc()
+                cls._local.set(str(_id), value)
+        return found, stale
+
+    @classmethod
+    async def set_many(cls, users: list, generations: dict[str, str]) -> dict[str, bytes]:
+        """
+        Запись загруженных профилей
+
+        :param generations: поколения id, прочитанные до загрузки из БД
+        """
+        rendered = {str(user.id): cls.render(user) for user in users}
+        if not rendered:
+            return rendered
+        async with cls._redis().pipeline(transaction=False) as pipe:
+            for _id, value in rendered.items():
+                pipe.eval(
+                    STORE_IF_GENERATION, 2, cls._key(_id), cls._generation_key(_id),
+                    value, generations[_id], cls._expire + cls._stale
+                )
+            stored = await pipe.execute()
+        for (_id, value), ok in zip(rendered.items(), stored):
+            if ok:
+                cls._local.set(_id, value)
+            else:
+                cls._stats["stale_loads"] += 1
+        return rendered
+
+    @classmethod
+    async def _load_from_db(cls, ids: list, loader) -> dict[str, bytes]:
+        generations = dict(zip((str(_id) for _id in ids), await cls._generations(ids)))
+        cls._stats["loads"] += 1
+        return await cls.set_many(await loader(ids), generations)
+
+    @classmethod
+    async def get_or_load(cls, _id, loader) -> bytes | None:
+        """
+        JSON профиля из кэша или из БД
+
+        :param loader: корутина, возвращающая модель аккаунта по id
+        """
+        async def batch_loader(ids):
+            user = await loader(ids[0])
+            return [] if user is None else [user]
+
+        users = await cls.get_many_or_load([_id], batch_loader)
+        return users[0] if users else None
+
+    @classmethod
+    async def get_many_or_load(cls, ids: list, loader) -> list[bytes]:
+        """
+        JSON профилей из кэша, промахи загружаются одним вызовом loader
+
+        :param loader: корутина, возвращающая модели аккаунтов по списку id
+        """
+        ids = cls._canonical(ids)
+        cached, stale = await cls.get_many(ids)
+        if stale:
+            cls._refresh(stale, loader)
+        missed = [_id for _id in ids if str(_id) not in cached]
+        if missed:
+            cached.update(await cls._load(missed, loader))
+        return [cached[str(_id)] for _id in ids if str(_id) in cached]
+
+    @classmethod
+    async def _load(cls, ids: list, loader) -> dict[str, bytes]:
+        """Загрузка с объединением одновременных запросов одного id"""
+        loop = asyncio.get_running_loop()
+        own = []
+        waiting = {}
+        for _id in ids:
+            future = cls._inflight.get(str(_id))
+            if future is None:
+                own.append(_id)
+                cls._inflight[str(_id)] = loop.create_future()
+            else:
+                cls._stats["coalesced"] += 1
+                waiting[str(_id)] = future
+
+        result = {}
+        if own:
+            try:
+                result = await cls._load_locked(own, loader)
+            except BaseException as e:
+                for _id in own:
+                    future = cls._inflight.pop(str(_id))
+                    future.set_exception(e)
+                    future.exception()
+                raise
+            for _id in own:
+                cls._inflight.pop(str(_id)).set_result(result.get(str(_id)))
+
+        for key, future in waiting.items():
+            value = await asyncio.shield(future)
+            if value is not None:
+                result[key] = value
+        return result
+
+    @classmethod
+    async def _load_locked(cls, ids: list, loader) -> dict[str, bytes]:
+        """Загрузка из БД под блокировкой Redis, общей для всех воркеров"""
+        redis = cls._redis()
+        token = uuid.uuid4().hex
+        async with redis.pipeline(transaction=False) as pipe:
+            for _id in ids:
+                pipe.set(cls._lock_key(_id), token, nx=True, px=int(cls._lock_timeout * 1000))
+            locked = await pipe.execute()
+        own = [_id for _id, acquired in zip(ids, locked) if acquired]
+        others = [_id for _id, acquired in zip(ids, locked) if not acquired]
+
+        result = {}
+        try:
+            if own:
+                result.update(await cls._load_from_db(own, loader))
+        finally:
+            # Загрузка дольше PROFILE_LOCK_TIMEOUT не снимает блокировку,
+            # которую уже взял другой воркер
+            if own:
+                async with redis.pipeline(transaction=False) as pipe:
+                    for _id in own:
+                        pipe.eval(RELEASE_LOCK, 1, cls._lock_key(_id), token)
+                    await pipe.execute()
+
+        # Профили, которые загружает другой воркер, ждем в Redis, но не
+        # дольше блокировки, после чего загружаем сами
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + cls._lock_timeout
+        while others and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+            values = await redis.mget([cls._key(_id) for _id in others])
+            for _id, value in zip(list(others), values):
+                if value is not None:
+                    result[str(_id)] = value.encode()
+                    others.remove(_id)
+        if others:
+            result.update(await cls._load_from_db(others, loader))
+        return result
+
+    @classmethod
+    def _refresh(cls, ids: list, loader):
+        ids = [_id for _id in ids if str(_id) not in cls._refreshing]
+        if not ids:
+            return
+
+        async def refresh():
+            try:
+                await cls._load(ids, loader)
+            except Exception as e:
+                # Устаревшая запись продолжает отдаваться до истечения окна
+                cls._stats["refresh_errors"] += 1
+                logger.exception(e)
+            finally:
+                cls._refreshing.difference_update(str(_id) for _id in ids)
+
+        cls._refreshing.update(str(_id) for _id in ids)
+        task = asyncio.create_task(refresh())
+        cls._tasks.add(task)
+        task.add_done_callback(cls._tasks.discard)
+
+    @classmethod
+    async def invalidate(cls, *ids):
+        if not ids:
+            return
+        ids = cls._canonical(ids)
+        for _id in ids:
+            cls._local.pop(str(_id))
+        try:
+            redis = cls._redis()
+            async with redis.pipeline(transaction=False) as pipe:
+                # Поколение меняется раньше удаления записи
+                for _id in ids:
+                    pipe.incr(cls._generation_key(_id))
+                    pipe.expire(cls._generation_key(_id), cls._expire + cls._stale)
+                pipe.delete(*[cls._key(_id) for _id in ids])
+                await pipe.execute()
+            await redis.publish(cls._channel, ",".join(str(_id) for _id in ids))
+        except Exception as e:
+            logger.exception(e)
+
+    @classmethod
+    async def _listen(cls):
+        while True:
+            pubsub = cls._redis().pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(cls._channel)
+                # За время переподключения могли пропустить сообщения
+                cls._local.clear()
+                async for message in pubsub.listen():
+                    for _id in message["data"].split(","):
+                        cls._local.pop(_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(e)
+                await asyncio.sleep(1)
+            finally:
+                with contextlib.suppress(Exception):
+                    await pubsub.aclose()
+
+    @classmethod
+    def start(cls):
+        cls._listener = asyncio.create_task(cls._listen())
+
+    @classmethod
+    async def stop(cls):
+        if cls._listener is not None:
+            cls._listener.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await cls._listener
+            cls._listener = None
+
+    @classmethod
+    def stats(cls) -> dict:
+        total = cls._stats["redis_hits"] + cls._stats["redis_misses"]
+        return {
+            "local": cls._local.stats(),
+            "redis": {
+                **cls._stats,
+                "hit_ratio": round(cls._stats["redis_hits"] / total, 4) if total else 0.0,
+            },
+            "inflight": len(cls._inflight),
+        }
@@ -1,10 +1,18 @@
+import asyncio
 import enum
+import functools
+import hashlib
 import logging
-
-import boto3
-from boto3.exceptions import Boto3Error
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator
 
 from config import settings
+from helpers.exceptions import UploadNotFoundError, UploadTooLargeError, WrongArgumentsError
+from helpers.images import AVATAR_RENDITIONS, ImageProcessor
+from helpers.metrics import STORAGE_DURATION, STORAGE_ERRORS
+from helpers.storage import StorageBackend, StoredObject, create_backend
 
 logger = logging.getLogger(__name__)
 
@@ -14,17 +22,237 @@ class Buckets(enum.Enum):
     back_pads = settings.BUCKET_NAME_BACK_PADS
 
 
+DEFAULT_KEYS = {"default-avatar-dark.png", "default-back-pad-dark.png"}
+# Ограничение S3 на число ключей в одном delete_objects
+DELETE_BATCH_SIZE = 1000
+
+
 class CloudMediaStorageAdapter:
 
-    """Класс для работы с S3 хранилищем"""
+    """
+    Класс для работы с хранилищем медиа
+
+    Хранилище (S3, локальный каталог или память) выбирается в
+    STORAGE_BACKEND и создается при первом обращении. Его методы
+    блокирующие, поэтому выполняются в отдельном пуле потоков. Число
+    одновременных запросов ограничено S3_MAX_CONCURRENCY, лишние ждут в
+    event loop, не занимая потоки.
+    """
 
-    _access_key = settings.SELECTEL_S3_ACCESS_KEY
-    _secret_key = settings.SELECTEL_S3_SECRET_KEY
     _avatars_link = settings.AVATARS_LINK
     _back_pads_link = settings.BACK_PADS_LINK
-    _s3 = boto3.client("s3", endpoint_url="https://s3.storage.selcloud.ru",
-                       region_name="ru-1",
-                       aws_access_key_id=_access_key, aws_secret_access_key=_secret_key)
+    _backend: StorageBackend | None = None
+    _executor: ThreadPoolExecutor | None = None
+    _semaphore = asyncio.Semaphore(settings.S3_MAX_CONCURRENCY)
+    _stats = {"in_flight": 0, "waiting": 0}
+    _operations: dict[str, dict] = {}
+
+    @classmethod
+    def _get_executor(cls) -> ThreadPoolExecutor:
+        if CloudMediaStorageAdapter._executor is None:
+            CloudMediaStorageAdapter._executor = ThreadPoolExecutor(
+                max_workers=settings.S3_MAX_CONCURRENCY, thread_name_prefix="storage"
+            )
+        return CloudMediaStorageAdapter._executor
+
+    @classmethod
+    def get_backend(cls) -> StorageBackend:
+        # Хранилище и пул потоков общие для наследников
+        if CloudMediaStorageAdapter._backend is None:
+            CloudMediaStorageAdapter._backend = create_backend()
+        return CloudMediaStorageAdapter._backend
+
+    @classmethod
+    def use_backend(cls, backend: StorageBackend):
+        """Замена хранилища, для замеров и локального запуска"""
+        CloudMediaStorageAdapter._backend = backend
+
+    @classmethod
+    async def _call(cls, operation: str, *args, **kwargs):
+        """Вызов метода хранилища в пуле потоков с учетом времени выполнения"""
+        return await cls._run(operation, getattr(cls.get_backend(), operation), *args, **kwargs)
+
+    @classmethod
+    async def _run(cls, operation: str, func, *args, **kwargs):
+        metrics = cls._operations.setdefault(
+            operation, {"count": 0, "errors": 0, "total_seconds": 0.0, "max_seconds": 0.0}
+        )
+        loop = asyncio.get_running_loop()
+        cls._stats["waiting"] += 1
+        async with cls._semaphore:
+            cls._stats["waiting"] -= 1
+            cls._stats["in_flight"] += 1
+            tm_start = time.perf_counter()
+            try:
+                return await loop.run_in_executor(
+                    cls._get_executor(), functools.partial(func, *args, **kwargs)
+                )
+            except Exception:
+                metrics["errors"] += 1
+                STORAGE_ERRORS.labels(operation).inc()
+                raise
+            finally:
+                elapsed = time.perf_counter() - tm_start
+                STORAGE_DURATION.labels(operation).observe(elapsed)
+                cls._stats["in_flight"] -= 1
+                metrics["count"] += 1
+                metrics["total_seconds"] += elapsed
+                metrics["max_seconds"] = max(metrics["max_seconds"], elapsed)
+
+    @classmethod
+    def stats(cls) -> dict:
+        return {
+            "backend": cls._backend.name if cls._backend is not None else None,
+            "max_concurrency": settings.S3_MAX_CONCURRENCY,
+            **cls._stats,
+            "operations": {
+                operation: {
+                    **metrics,
+                    "avg_seconds": round(metrics["total_seconds"] / metrics["count"], 6)
+                    if metrics["count"] else 0.0,
+                }
+                for operation, metrics in cls._operations.items()
+            },
+        }
+
+    @classmethod
+    def shutdown(cls):
+        if cls._executor is not None:
+            cls._executor.shutdown(wait=True)
+            cls._executor = None
+
+    @classmethod
+    async def upload_stream(cls, bucket: str, key: str, chunks: AsyncIterator[bytes]):
+        """
+        Загрузка из потока частями по S3_UPLOAD_PART_SIZE байт
+
+        В памяти держится не больше одной части. Файл, уместившийся в одну
+        часть, загружается одним запросом. Если поток прервался
+        ошибкой, начатая multipart-загрузка отменяется.
+        """
+        part_size = settings.S3_UPLOAD_PART_SIZE
+        buffer = bytearray()
+        upload_id = None
+        parts = []
+        try:
+            async for chunk in chunks:
+                buffer += chunk
+                if len(buffer) < part_size:
+                    continue
+                if upload_id is None:
+                    upload_id = await cls._call("create_multipart", bucket, key)
+                etag = await cls._call("upload_part", bucket, key, upload_id, len(parts) + 1, buffer)
+                parts.append({"PartNumber": len(parts) + 1, "ETag": etag})
+                buffer = bytearray()
+            if upload_id is None:
+                await cls._call("put", bucket, key, buffer)
+                return
+            if buffer:
+                etag = await cls._call("upload_part", bucket, key, upload_id, len(parts) + 1, buffer)
+                parts.append({"PartNumber": len(parts) + 1, "ETag": etag})
+            await cls._call("complete_multipart", bucket, key, upload_id, parts)
+        except BaseException:
+            if upload_id is not None:
+                try:
+                    await cls._call("abort_multipart", bucket, key, upload_id)
+                except Exception as e:
+                    logger.exception(e)
+            raise
+
+    @classmethod
+    async def stage_stream(cls, bucket: str, chunks: AsyncIterator[bytes], suffix: str = "") -> "StagedUpload":
+        """
+        Прием файла из потока с ключом по sha256 содержимого
+
+        Ключ известен только после чтения всего файла. Файл в одну часть
+        остается в памяти, больший загружается под временным ключом uploads/.
+        """
+        digest = hashlib.sha256()
+        head = bytearray()
+        async for chunk in chunks:
+            digest.update(chunk)
+            head += chunk
+            if len(head) >= settings.S3_UPLOAD_PART_SIZE:
+                break
+        else:
+            return StagedUpload(bucket, f"{digest.hexdigest()}{suffix}", body=head)
+
+        async def rest():
+            yield head
+            async for chunk in chunks:
+                digest.update(chunk)
+                yield chunk
+
+        temp_key = f"uploads/{uuid.uuid4().hex}{suffix}"
+        await cls.upload_stream(bucket, temp_key, rest())
+        return StagedUpload(bucket, f"{digest.hexdigest()}{suffix}", temp_key=temp_key)
+
+    @staticmethod
+    def upload_prefix(_id) -> str:
+        return f"uploads/{_id}/"
+
+    @classmethod
+    async def presign_upload(cls, bucket: str, _id) -> dict:
+        """
+        Подписанная форма POST для загрузки файла клиентом напрямую в бакет
+
+        Ключ выбирается сервером в uploads/{_id}/, размер ограничивается
+        политикой на стороне хранилища.
+        """
+        key = f"{cls.upload_prefix(_id)}{uuid.uuid4().hex}"
+        # Первый вызов создает клиент boto3, поэтому тоже в пуле потоков
+        form = await cls._call(
+            "presign_post", bucket, key, settings.UPLOAD_MAX_SIZE, settings.PRESIGNED_UPLOAD_EXPIRE
+        )
+        return {
+            "url": form["url"],
+            "fields": form["fields"],
+            "key": key,
+            "expiresIn": settings.PRESIGNED_UPLOAD_EXPIRE,
+        }
+
+    @classmethod
+    async def check_upload(cls, bucket: str, key: str, _id):
+        """Проверка, что файл загружен этим пользователем и не больше допустимого"""
+        if not key.startswith(cls.upload_prefix(_id)) or ".." in key:
+            raise WrongArgumentsError("Upload key does not belong to the user")
+        stored = await cls._call("stat", bucket, key)
+        if stored is None:
+            raise UploadNotFoundError("Upload not found")
+        if stored.size > settings.UPLOAD_MAX_SIZE:
+            await cls.delete_media(bucket, [key])
+            raise UploadTooLargeError(f"File is larger than {settings.UPLOAD_MAX_SIZE} bytes")
+
+    @classmethod
+    async def read_stream(cls, bucket: str, key: str, chunk_size: int = 1024 * 1024) -> AsyncIterator[bytes]:
+        body = await cls._call("open", bucket, key)
+        try:
+            while chunk := await cls._run("read_object", body.read, chunk_size):
+                yield chunk
+        finally:
+            body.close()
+
+    @classmethod
+    async def read_object(cls, bucket: str, key: str) -> bytes:
+        data = bytearray()
+        async for chunk in cls.read_stream(bucket, key):
+            data += chunk
+        return bytes(data)
+
+    @classmethod
+    async def stage_object(cls, bucket: str, key: str, suffix: str = "") -> "StagedUpload":
+        """Файл, загруженный клиентом по подписанной ссылке, как StagedUpload"""
+        digest = hashlib.sha256()
+        async for chunk in cls.read_stream(bucket, key):
+            digest.update(chunk)
+        return StagedUpload(bucket, f"{digest.hexdigest()}{suffix}", temp_key=key)
+
+    @classmethod
+    def get_media_key(cls, link: str, avatar: bool = False, back_pad: bool = False) -> str:
+        if avatar:
+            return link.replace(f"{cls._avatars_link}/", "")
+        if back_pad:
+            return link.replace(f"{cls._back_pads_link}/", "")
 
     @classmethod
     def get_media_prefix(cls, key: str, avatar: bool = False, back_pad: bool = False) -> str:
@@ -42,51 +270,108 @@ class CloudMediaStorageAdapter:
         return f"{cls._back_pads_link}/default-back-pad-dark.png"
 
     @classmethod
-    def delete_avatar(cls, link: str):
-        key = link.replace(f"{cls._avatars_link}/", "")
-        if key == "default-avatar-dark.png":
-            return
-        try:
-            cls._s3.delete_object(
-                Bucket=Buckets.avatars.value,
-                Key=key
-            )
-        except Boto3Error as e:
-            logger.exception(e)
+    async def delete_media(cls, bucket: str, keys: list[str]) -> list[str]:
+        """
+        Удаление объектов запросами delete_objects до 1000 ключей
+
+        Изображения по умолчанию не удаляются. Возвращает ключи, которые
+        удалить не удалось.
+        """
+        keys = [key for key in keys if key not in DEFAULT_KEYS]
+        failed = []
+        for start in range(0, len(keys), DELETE_BATCH_SIZE):
+            batch = keys[start:start + DELETE_BATCH_SIZE]
+            try:
+                failed.extend(await cls._call("delete_many", bucket, batch))
+            except Exception as e:
+                logger.exception(e)
+                failed.extend(batch)
+        return failed
 
     @classmethod
-    def delete_back_pad(cls, link: str):
-        key = link.replace(f"{cls._back_pads_link}/", "")
-        if key == "default-back-pad-dark.png":
+    async def list_objects(cls, bucket: str, start_after: str | None, limit: int) -> tuple[list[StoredObject], bool]:
+        """Страница объектов бакета по возрастанию ключа и признак, что есть еще"""
+        return await cls._call("list", bucket, start_after, limit)
+
+
+class StagedUpload:
+
+    """
+    Принятый файл, ожидающий записи под постоянным ключом
+
+    store() вызывается, только если объекта с таким содержимым еще нет,
+    discard() - всегда после завершения, удаляет временный объект.
+    """
+
+    def __init__(self, bucket: str, key: str, body: bytearray | None = None,
+                 temp_key: str | None = None):
+        self.bucket = bucket
+        self.key = key
+        self.body = body
+        self.temp_key = temp_key
+
+    async def store(self, keys: list[str] | None = None):
+        if self.temp_key is None:
+            await CloudMediaStorageAdapter._call("put", self.bucket, self.key, self.body)
+        else:
+            await CloudMediaStorageAdapter._call("copy", self.bucket, self.temp_key, self.key)
+
+    async def discard(self):
+        if self.temp_key is not None:
+            await CloudMediaStorageAdapter.delete_media(self.bucket, [self.temp_key])
+            self.temp_key = None
+
+
+class StagedAvatar:
+
+    """
+    Загруженный аватар, ключи версий - sha256 исходного файла
+
+    Версии рендерятся только при первой записи: повторная загрузка того же
+    файла не тратит ни CPU, ни запросы PUT.
+    """
+
+    def __init__(self, data: bytes):
+        self.data = data
+        digest = hashlib.sha256(data).hexdigest()
+        self.file_names = {name: f"{digest}-{name}.webp" for name in AVATAR_RENDITIONS}
+        self._renditions: dict[str, bytes] = {}
+        self._stored: set[str] = set()
+
+    async def store(self, keys: list[str]):
+        missing = [
+            name for name, key in self.file_names.items()
+            if key in keys and key not in self._stored
+        ]
+        if not missing:
             return
-        try:
-            cls._s3.delete_object(
-                Bucket=Buckets.back_pads.value,
-                Key=key
-            )
-        except Boto3Error as e:
-            logger.exception(e)
+        if not self._renditions:
+            self._renditions = await ImageProcessor.render_avatar(self.data)
+        await asyncio.gather(
+            *[
+                AvatarsUploader.upload_avatar(self._renditions[name], self.file_names[name])
+                for name in missing
+            ]
+        )
+        self._stored.update(self.file_names[name] for name in missing)
+
+    async def discard(self):
+        pass
 
 
 class AvatarsUploader(CloudMediaStorageAdapter):
     __bucket = settings.BUCKET_NAME_AVATARS
 
     @classmethod
-    def upload_avatar(cls, file_: bytes, file_name: str):
-        try:
-            cls._s3.put_object(Bucket=cls.__bucket, Key=file_name, Body=file_)
-        except Boto3Error as e:
-            logger.exception(e)
+    async def upload_avatar(cls, file_: bytes, file_name: str, content_type: str = "image/webp"):
+        await cls._call("put", cls.__bucket, file_name, file_, content_type)
 
 
 class BackPadsUploader(CloudMediaStorageAdapter):
     __bucket = settings.BUCKET_NAME_BACK_PADS
 
     @classmethod
-    def upload_back_pads(cls, file_: bytes, file_name: str):
-        try:
-            cls._s3.put_object(Bucket=cls.__bucket, Key=file_name, Body=file_)
-        except Boto3Error as e:
-            logger.exception(e)
+    async def upload_back_pads(cls, file_: AsyncIterator[bytes]) -> StagedUpload:
+        return await cls.stage_stream(cls.__bucket, file_, suffix=".png")
 
 
@@ -1,22 +1,187 @@
+import asyncio
 import logging
+import random
+import time
 
 import httpx
 
 from config import settings
 from endpoints.dto import UserCreateModel
 from helpers.cloud_storage import CloudMediaStorageAdapter
+from helpers.exceptions import CircuitOpenError, DownstreamError
+from helpers.metrics import DOWNSTREAM_DURATION, DOWNSTREAM_ERRORS
 
 
 logger = logging.getLogger(__name__)
 
 
+class CircuitBreaker:
+
+    """
+    Размыкатель цепи для одного сервиса
+
+    После failure_threshold неудачных вызовов подряд запросы отклоняются
+    сразу. Через reset_timeout пропускается один пробный запрос: успех
+    замыкает цепь, ошибка снова размыкает ее.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._trial = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self._trial:
+            self._trial = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._trial or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self._trial = False
+
+    def release_trial(self):
+        self._trial = False
+
+
+class Downstream:
+
+    """Долгоживущий HTTP-клиент к одному сервису с повторами и размыкателем цепи"""
+
+    def __init__(self, name: str, base_url: str, token: str):
+        self.name = name
+        self.base_url = base_url
+        self.token = token
+        self.client: httpx.AsyncClient | None = None
+        self.breaker = CircuitBreaker(
+            settings.CROSS_SERVICE_BREAKER_THRESHOLD, settings.CROSS_SERVICE_BREAKER_RESET
+        )
+        self.stats = {"requests": 0, "retries": 0, "errors": 0, "rejected": 0}
+
+    def start(self):
+        if self.client is not None:
+            return
+        self.client = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers={"cross-service-token": self.token},
+            http2=settings.CROSS_SERVICE_HTTP2,
+            limits=httpx.Limits(
+                max_connections=settings.CROSS_SERVICE_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.CROSS_SERVICE_MAX_KEEPALIVE,
+            ),
+            timeout=httpx.Timeout(
+                settings.CROSS_SERVICE_TIMEOUT, connect=settings.CROSS_SERVICE_CONNECT_TIMEOUT
+            ),
+        )
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    @staticmethod
+    def _backoff(attempt: int) -> float:
+        # Экспоненциальная задержка с полным джиттером
+        ceiling = min(settings.CROSS_SERVICE_BACKOFF_MAX, settings.CROSS_SERVICE_BACKOFF * 2 ** attempt)
+        return random.uniform(0, ceiling)
+
+    async def request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        """Запрос с повторами на ошибки сети и ответы 5xx"""
+        if not self.breaker.allow():
+            self.stats["rejected"] += 1
+            DOWNSTREAM_ERRORS.labels(self.name, "circuit_open").inc()
+            raise CircuitOpenError(f"{self.name} service is unavailable")
+        self.start()
+        try:
+            response = await self._send(method, path, **kwargs)
+        except asyncio.CancelledError:
+            self.breaker.release_trial()
+            raise
+        except Exception:
+            self.stats["errors"] += 1
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return response
+
+    async def _send(self, method: str, path: str, **kwargs) -> httpx.Response:
+        retries = settings.CROSS_SERVICE_RETRIES
+        for attempt in range(retries + 1):
+            self.stats["requests"] += 1
+            tm_start = time.perf_counter()
+            try:
+                response = await self.client.request(method, path, **kwargs)
+                if response.status_code < 500:
+                    return response
+                error = f"status code {response.status_code}"
+                DOWNSTREAM_ERRORS.labels(self.name, "status_5xx").inc()
+            except httpx.TransportError as e:
+                error = f"{type(e).__name__}: {e}"
+                DOWNSTREAM_ERRORS.labels(self.name, "transport").inc()
+            finally:
+                DOWNSTREAM_DURATION.labels(self.name, method).observe(time.perf_counter() - tm_start)
+            logger.warning(f"{self.name} {method} {path} failed ({error}), attempt {attempt + 1}")
+            if attempt < retries:
+                self.stats["retries"] += 1
+                await asyncio.sleep(self._backoff(attempt))
+        raise DownstreamError(f"{self.name} {method} {path} failed: {error}")
+
+
 class CrossService:
-    __community_service = settings.COMMUNITY_SERVICE_URL
-    __community_service_token = settings.COMMUNITY_SERVICE_TOKEN
+    community = Downstream(
+        "community", settings.COMMUNITY_SERVICE_URL, settings.COMMUNITY_SERVICE_TOKEN
+    )
+    event = Downstream(
+        "event", settings.EVENT_SERVICE_URL, settings.EVENT_SERVICE_TOKEN
+    )
+    organiser = Downstream(
+        "organiser", settings.ORGANISER_SERVICE_URL, settings.ORGANISER_SERVICE_TOKEN
+    )
+
+    @classmethod
+    def _downstreams(cls) -> list[Downstream]:
+        return [cls.community, cls.event, cls.organiser]
 
     @classmethod
-    async def add_user(cls, _id, user: UserCreateModel):
-        payload = {
+    def start(cls):
+        for downstream in cls._downstreams():
+            downstream.start()
+
+    @classmethod
+    async def close(cls):
+        for downstream in cls._downstreams():
+            await downstream.close()
+
+    @classmethod
+    def stats(cls) -> dict:
+        return {
+            downstream.name: {"state": downstream.breaker.state, **downstream.stats}
+            for downstream in cls._downstreams()
+        }
+
+    @staticmethod
+    def registration_payload(_id, user: UserCreateModel) -> dict:
+        return {
             "id": _id,
             "username": user.username,
             "firstName": user.firstName,
@@ -24,17 +189,3 @@ class CrossService:
             "mediaUrl": CloudMediaStorageAdapter.get_default_avatar(),
             "isPrime": False
         }
-        headers = {
-            "cross-service-token": cls.__community_service_token,
-        }
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{cls.__community_service}/register",
-                json=payload,
-                headers=headers
-            )
-            logger.info(f"Response status code: {response.status_code}")
-            logger.info(f"Response text: {response.text}")
-            if response.status_code == 500:
-                logger.error("Error while adding user to community service")
-                await cls.add_user(_id, user)
@@ -1,16 +1,21 @@
 import logging
+import random
 import time
 import uuid
 from functools import wraps
 
 from fastapi import Request, HTTPException
 
+from config import settings
+from helpers.log import request_id_var
+
 logger = logging.getLogger(__name__)
-sys_logger = logging.getLogger('sys_logger')
 
 STATUS_MAP = {
     "AlreadyExistsError": 409,
     "WrongArgumentsError": 400,
+    "UploadTooLargeError": 413,
+    "UploadNotFoundError": 404,
     "NotFountError": 404,
     "InvalidTokenError": 498,
     "AccessDenied": 403,
@@ -24,33 +29,36 @@ def router_decorator(request: Request):
 
     :param request: Данные запроса
 
-    Фиксируем время обработки запроса и присваиваем ему id для отслеживания.
+    Фиксируем время обработки запроса и присваиваем ему id для отслеживания
+    (берется из заголовка X-Request-ID, если он есть). Id доступен всем
+    логам запроса через request_id_var. Успешные запросы логируются с
+    вероятностью LOG_SAMPLE_RATE, ошибки - всегда.
     Имеет встроенные обработчик ошибок.
     """
     def decorator(coro):
         @wraps(coro)
         async def wrapper(*args, **kwargs):
-            tm_start = time.time()
-            request_id = str(uuid.uuid4())
-            logger.info(
-                f"Start handling request [{request.method}] - {request.url}. Assigned ID: {request_id}"
-            )
-            logger.debug(
-                f"RequestID: {request_id} - request: {str(request.headers)}; "
-                f"Query: {str(request.query_params)}; Body: {str(request.body)}"
-            )
+            tm_start = time.perf_counter()
+            request_id = request.headers.get("x-request-id", "")[:128] or str(uuid.uuid4())
+            token = request_id_var.set(request_id)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Request headers: %s; Query: %s", request.headers, request.query_params)
+            status_code = 200
             try:
-                return await coro(*args, **kwargs)
-            except HTTPException:
+                response = await coro(*args, **kwargs)
+                status_code = getattr(response, "status_code", status_code)
+                return response
+            except HTTPException as e:
+                status_code = e.status_code
                 raise
             except Exception as e:
                 status_code = STATUS_MAP.get(type(e).__name__, None)
                 if status_code is None:
                     status_code = 500
                 logger.error(
-                    f"Exception occurred while handling request [{request.method}] - {request.url}; "
-                    f"RequestID: {request_id} "
-                    f"Error: {type(e).__name__}-{str(e)}"
+                    "Exception occurred while handling request [%s] - %s; Error: %s-%s",
+                    request.method, request.url.path, type(e).__name__, e,
+                    exc_info=status_code == 500
                 )
                 raise HTTPException(
                     status_code=status_code,
@@ -61,15 +69,12 @@ def router_decorator(request: Request):
                     }
                 )
             finally:
-                tm_end = time.time()
-                logger.info(
-                    f"Finish handling request [{request.method}] - {request.url} RequestID: {request_id}"
-                )
-                sys_logger.info(
-                    f"Handling request {request_id} took {tm_end - tm_start:.2f}s; "
-                )
+                if status_code >= 400 or random.random() < settings.LOG_SAMPLE_RATE:
+                    logger.info(
+                        "Handled request [%s] - %s", request.method, request.url.path,
+                        extra={"status": status_code,
+                               "duration_ms": round((time.perf_counter() - tm_start) * 1000, 3)}
+                    )
+                request_id_var.reset(token)
         return wrapper
     return decorator
-
-
-
@@ -18,4 +18,24 @@ def raiser_routing_exception(e: Exception, code=400):
             "reason": err_reason,
             "message": err_msg
         }
-    )
\ No newline at end of file
+    )
+
+
+class CircuitOpenError(Exception):
+    """Сервис временно недоступен, запросы к нему не отправляются"""
+
+
+class DownstreamError(Exception):
+    """Сервис не ответил успешно после всех повторов"""
+
+
+class WrongArgumentsError(Exception):
+    """Некорректные данные запроса"""
+
+
+class UploadTooLargeError(Exception):
+    """Загружаемый файл больше допустимого размера"""
+
+
+class UploadNotFoundError(Exception):
+    """Файл по подписанной ссылке не загружен или уже обработан"""
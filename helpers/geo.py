@@ -0,0 +1,108 @@
+import hashlib
+import logging
+from types import MappingProxyType
+from typing import NamedTuple
+
+from sqlalchemy import select
+
+from database.connector import async_session
+from database.models import Cities, Regions, FederalDistricts
+
+logger = logging.getLogger(__name__)
+
+
+class GeoCity(NamedTuple):
+    id: int
+    name: str
+    region_id: int
+    region: str
+    federal_district_id: int
+    federal_district: str
+
+
+class _TrieNode:
+    __slots__ = ("children", "ids")
+
+    def __init__(self):
+        self.children = {}
+        self.ids = []
+
+
+def _normalize(name: str) -> str:
+    return name.strip().casefold().replace("ё", "е")
+
+
+class GeoIndex:
+
+    """
+    Справочник городов, регионов и федеральных округов в памяти процесса
+
+    Таблицы статичны, поэтому загружаются один раз при старте приложения.
+    Поиск по имени и id - O(1), автодополнение - по префиксному дереву.
+    """
+
+    _cities: MappingProxyType = MappingProxyType({})
+    _city_ids: MappingProxyType = MappingProxyType({})
+    _trie: _TrieNode = _TrieNode()
+    etag: str = '""'
+
+    @classmethod
+    async def load(cls):
+        async with async_session() as session:
+            districts = await session.execute(select(FederalDistricts.id, FederalDistricts.name))
+            districts = dict(districts.all())
+            regions = await session.execute(select(Regions.id, Regions.name))
+            regions = dict(regions.all())
+            cities = await session.execute(
+                select(Cities.id, Cities.name, Cities.region_id, Cities.federal_district_id)
+                .order_by(Cities.id)
+            )
+            cities = cities.all()
+
+        by_id = {}
+        by_name = {}
+        for _id, name, region_id, district_id in cities:
+            by_id[_id] = GeoCity(
+                id=_id,
+                name=name,
+                region_id=region_id,
+                region=regions.get(region_id),
+                federal_district_id=district_id,
+                federal_district=districts.get(district_id),
+            )
+            by_name.setdefault(name, _id)
+
+        root = _TrieNode()
+        for city in sorted(by_id.values(), key=lambda c: (_normalize(c.name), c.id)):
+            node = root
+            for char in _normalize(city.name):
+                node = node.children.setdefault(char, _TrieNode())
+                node.ids.append(city.id)
+
+        digest = hashlib.sha1(repr(sorted(by_id.values())).encode()).hexdigest()
+        cls._cities = MappingProxyType(by_id)
+        cls._city_ids = MappingProxyType(by_name)
+        cls._trie = root
+        cls.etag = f'"{digest[:20]}"'
+        logger.info(f"Geo index loaded: {len(by_id)} cities, {len(regions)} regions")
+
+    @classmethod
+    def city_id(cls, name: str) -> int | None:
+        return cls._city_ids.get(name)
+
+    @classmethod
+    def city(cls, _id: int) -> GeoCity | None:
+        return cls._cities.get(_id)
+
+    @classmethod
+    def cities(cls) -> list[GeoCity]:
+        return list(cls._cities.values())
+
+    @classmethod
+    def search(cls, prefix: str, limit: int = 10) -> list[GeoCity]:
+        node = cls._trie
+        for char in _normalize(prefix):
+            node = node.children.get(char)
+            if node is None:
+                return []
+        return [cls._cities[_id] for _id in node.ids[:limit]]
@@ -0,0 +1,111 @@
+import asyncio
+import io
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from config import settings
+from helpers.exceptions import WrongArgumentsError
+
+ALLOWED_FORMATS = {"JPEG", "PNG", "WEBP", "GIF"}
+# Имя версии -> максимальная сторона, квадратные версии обрезаются по центру
+AVATAR_RENDITIONS = {
+    "thumbnail": (settings.AVATAR_THUMBNAIL_SIZE, True),
+    "medium": (settings.AVATAR_MEDIUM_SIZE, True),
+    "original": (settings.AVATAR_ORIGINAL_MAX_SIZE, False),
+}
+
+Image.MAX_IMAGE_PIXELS = settings.AVATAR_MAX_PIXELS
+
+
+def _encode(image: Image.Image) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format="WEBP", quality=settings.AVATAR_WEBP_QUALITY, method=4)
+    return buffer.getvalue()
+
+
+def render_avatar(data: bytes) -> dict[str, bytes]:
+    """
+    Проверка и перекодирование аватара в WebP для всех версий
+
+    Выполняется в процессе пула. Некорректное изображение - ValueError.
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+    except UnidentifiedImageError:
+        raise ValueError("Unsupported image") from None
+    except Image.DecompressionBombError:
+        image = None
+    if image is None or image.width * image.height > settings.AVATAR_MAX_PIXELS:
+        raise ValueError(f"Image is larger than {settings.AVATAR_MAX_PIXELS} pixels")
+    if image.format not in ALLOWED_FORMATS:
+        raise ValueError(f"Unsupported image format: {image.format}")
+    try:
+        image.load()
+    except OSError as e:
+        raise ValueError(f"Broken image: {e}") from None
+    image = ImageOps.exif_transpose(image)
+    has_alpha = image.mode in ("RGBA", "LA") or "transparency" in image.info
+    image = image.convert("RGBA" if has_alpha else "RGB")
+
+    renditions = {}
+    for name, (size, square) in AVATAR_RENDITIONS.items():
+        if square:
+            side = min(size, image.width, image.height)
+            rendition = ImageOps.fit(image, (side, side), Image.Resampling.LANCZOS)
+        else:
+            rendition = image.copy()
+            rendition.thumbnail((size, size), Image.Resampling.LANCZOS)
+        renditions[name] = _encode(rendition)
+    return renditions
+
+
+class ImageProcessor:
+
+    """
+    Обработка изображений в пуле процессов
+
+    Декодирование и сжатие занимают CPU и держат GIL, поэтому выполняются в
+    отдельных процессах, а event loop воркера только ждет результат.
+    """
+
+    _pool_size = settings.IMAGE_POOL_SIZE
+    _executor: ProcessPoolExecutor | None = None
+    _stats = {"processed": 0, "rejected": 0, "in_flight": 0, "busy_seconds": 0.0}
+
+    @classmethod
+    def _get_executor(cls) -> ProcessPoolExecutor:
+        if cls._executor is None:
+            # spawn: форк процесса с запущенным event loop и потоками небезопасен
+            cls._executor = ProcessPoolExecutor(
+                max_workers=cls._pool_size, mp_context=multiprocessing.get_context("spawn")
+            )
+        return cls._executor
+
+    @classmethod
+    async def render_avatar(cls, data: bytes) -> dict[str, bytes]:
+        """Версии аватара в WebP, имя версии -> содержимое"""
+        loop = asyncio.get_running_loop()
+        cls._stats["in_flight"] += 1
+        tm_start = time.perf_counter()
+        try:
+            return await loop.run_in_executor(cls._get_executor(), render_avatar, data)
+        except ValueError as e:
+            cls._stats["rejected"] += 1
+            raise WrongArgumentsError(str(e)) from None
+        finally:
+            cls._stats["in_flight"] -= 1
+            cls._stats["processed"] += 1
+            cls._stats["busy_seconds"] += time.perf_counter() - tm_start
+
+    @classmethod
+    def stats(cls) -> dict:
+        return {"pool_size": cls._pool_size, **cls._stats}
+
+    @classmethod
+    def shutdown(cls):
+        if cls._executor is not None:
+            cls._executor.shutdown(wait=True)
+            cls._executor = None
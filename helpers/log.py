@@ -0,0 +1,93 @@
+import atexit
+import contextvars
+import datetime
+import json
+import logging
+import logging.config
+import logging.handlers
+import queue
+
+import yaml
+
+request_id_var: contextvars.ContextVar[str | None] = contextvars.ContextVar("request_id", default=None)
+
+# Атрибуты LogRecord, которые не попадают в JSON как дополнительные поля
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+
+    """Запись лога одной JSON-строкой, поля из extra добавляются как есть"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc)
+            .isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry["stack_info"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+
+    """
+    Передача записей в поток QueueListener без форматирования
+
+    Стандартный QueueHandler форматирует сообщение в вызывающем потоке, здесь
+    запись уходит в очередь как есть, а сообщение собирается из args уже в
+    потоке слушателя. Поэтому в args нельзя передавать объекты, которые
+    изменятся после вызова логгера. Идентификатор запроса берется из
+    контекста в вызывающем потоке.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.request_id = request_id_var.get()
+        return record
+
+
+_listeners: list[logging.handlers.QueueListener] = []
+
+
+def _enqueue(logger: logging.Logger):
+    """Переносит обработчики логгера в поток QueueListener"""
+    handlers = logger.handlers[:]
+    if not handlers:
+        return
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(ContextQueueHandler(records))
+    listener.start()
+    _listeners.append(listener)
+
+
+def setup_logging(path: str = "logging.yml"):
+    """
+    Настройка логирования из logging.yml
+
+    Файловые и консольные обработчики работают в отдельных потоках, event
+    loop только кладет записи в очередь.
+    """
+    with open(path, "r") as f:
+        config = yaml.safe_load(f.read())
+    logging.config.dictConfig(config)
+    _enqueue(logging.getLogger())
+    for name in config.get("loggers", {}):
+        _enqueue(logging.getLogger(name))
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Дописывает накопленные записи и останавливает потоки логирования"""
+    while _listeners:
+        _listeners.pop().stop()
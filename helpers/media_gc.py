@@ -0,0 +1,228 @@
+import asyncio
+import contextlib
+import datetime
+import logging
+import time
+import uuid
+
+from fastapi_cache import FastAPICache
+from sqlalchemy import select, delete, or_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from config import settings
+from database.connector import async_session
+from database.models import MediaObjects, UsersAvatars, UsersBackPads
+from helpers.cloud_storage import Buckets, CloudMediaStorageAdapter, DEFAULT_KEYS, DELETE_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Снятие и продление блокировки, только если ее держит этот проход
+RELEASE_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+EXTEND_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class MediaReaper:
+
+    """
+    Удаление из S3 объектов, на которые больше не ссылаются записи в БД
+
+    Объекты без ссылок помечены в media_objects (refcount = 0, released_at)
+    и удаляются через MEDIA_GC_GRACE, чтобы закэшированные профили со
+    старыми ссылками успели обновиться. Строки забираются пачками через
+    FOR UPDATE SKIP LOCKED, объекты удаляются одним delete_objects на пачку,
+    строка удаляется только после успешного удаления объекта. Скорость
+    ограничена MEDIA_GC_RATE ключей в секунду.
+
+    Дополнительно бакеты постранично обходятся по list_objects: объекты
+    старше MEDIA_GC_GRACE, которых нет ни в media_objects, ни в ссылках
+    аватаров и подложек (удаленные пользователи, брошенные uploads/),
+    помечаются для удаления. Позиция обхода хранится в Redis, поэтому после
+    перезапуска обход продолжается.
+
+    Проход выполняет один воркер за раз (блокировка в Redis), состояние
+    хранится в БД и Redis, поэтому прерванный проход безопасно продолжить.
+    """
+
+    _lock_key = "media-gc:lock"
+    _cursor_key = "media-gc:cursor"
+    _lock_timeout = 600
+    _interval = settings.MEDIA_GC_INTERVAL
+    _grace = datetime.timedelta(seconds=settings.MEDIA_GC_GRACE)
+    _batch_size = min(settings.MEDIA_GC_BATCH_SIZE, DELETE_BATCH_SIZE)
+    _task: asyncio.Task | None = None
+    _stats = {"deleted": 0, "failed": 0, "batches": 0, "scanned": 0, "marked": 0,
+              "passes": 0, "last_pass_seconds": 0.0, "errors": 0}
+
+    @classmethod
+    def _redis(cls):
+        return FastAPICache.get_backend().redis
+
+    @classmethod
+    async def reap_batch(cls) -> int:
+        """Удаляет одну пачку объектов, возвращает размер пачки"""
+        deadline = datetime.datetime.utcnow() - cls._grace
+        async with async_session() as session:
+            rows = await session.execute(
+                select(MediaObjects.bucket, MediaObjects.key)
+                .where(MediaObjects.refcount <= 0, MediaObjects.released_at <= deadline)
+                .order_by(MediaObjects.released_at)
+                .limit(cls._batch_size)
+                .with_for_update(skip_locked=True)
+            )
+            rows = rows.all()
+            if not rows:
+                return 0
+            by_bucket = {}
+            for bucket, key in rows:
+                by_bucket.setdefault(bucket, []).append(key)
+            # Строки заблокированы до коммита: загрузка того же содержимого
+            # дождется удаления объекта и запишет его заново
+            for bucket, keys in by_bucket.items():
+                failed = set(await CloudMediaStorageAdapter.delete_media(bucket, keys))
+                deleted = [key for key in keys if key not in failed]
+                if deleted:
+                    await session.execute(
+                        delete(MediaObjects).where(
+                            MediaObjects.bucket == bucket,
+                            MediaObjects.key.in_(deleted),
+                            MediaObjects.refcount <= 0
+                        )
+                    )
+                cls._stats["deleted"] += len(deleted)
+                cls._stats["failed"] += len(failed)
+            await session.commit()
+        cls._stats["batches"] += 1
+        return len(rows)
+
+    @staticmethod
+    def _referenced(bucket: str, links: list[str]):
+        """Запрос ссылок на объекты, сохраненных до адресации по содержимому"""
+        if bucket == Buckets.avatars.value:
+            columns = (UsersAvatars.mediaUrl, UsersAvatars.thumbnailUrl, UsersAvatars.mediumUrl)
+            return select(*columns).where(
+                or_(*[column.in_(links) for column in columns])
+            )
+        return select(UsersBackPads.mediaUrl).where(UsersBackPads.mediaUrl.in_(links))
+
+    @classmethod
+    async def sweep_page(cls, bucket: str) -> bool:
+        """
+        Помечает объекты одной страницы бакета, на которые нет ссылок
+
+        Возвращает True, если обход бакета дошел до конца.
+        """
+        redis = cls._redis()
+        cursor_key = f"{cls._cursor_key}:{bucket}"
+        cursor = await redis.get(cursor_key)
+        objects, truncated = await CloudMediaStorageAdapter.list_objects(
+            bucket, cursor, cls._batch_size
+        )
+        cls._stats["scanned"] += len(objects)
+        deadline = datetime.datetime.now(datetime.timezone.utc) - cls._grace
+        # Свежие объекты могут быть загружены, но еще не записаны в БД
+        keys = [
+            obj.key for obj in objects
+            if obj.modified <= deadline and obj.key not in DEFAULT_KEYS
+        ]
+        if keys:
+            avatar = bucket == Buckets.avatars.value
+            async with async_session() as session:
+                known = await session.execute(
+                    select(MediaObjects.key)
+                    .where(MediaObjects.bucket == bucket, MediaObjects.key.in_(keys))
+                )
+                candidates = set(keys) - set(known.scalars())
+                links = {
+                    CloudMediaStorageAdapter.get_media_prefix(key, avatar=avatar, back_pad=not avatar): key
+                    for key in candidates
+                }
+                if links:
+                    referenced = await session.execute(cls._referenced(bucket, list(links)))
+                    for row in referenced:
+                        for link in row:
+                            candidates.discard(links.get(link))
+                if candidates:
+                    now = datetime.datetime.utcnow()
+                    await session.execute(
+                        pg_insert(MediaObjects)
+                        .values([
+                            {"bucket": bucket, "key": key, "refcount": 0, "released_at": now}
+                            for key in candidates
+                        ])
+                        .on_conflict_do_nothing()
+                    )
+                    await session.commit()
+                    cls._stats["marked"] += len(candidates)
+        if truncated and objects:
+            await redis.set(cursor_key, objects[-1].key)
+            return False
+        await redis.delete(cursor_key)
+        return True
+
+    @classmethod
+    async def _extend_lock(cls, token: str) -> bool:
+        return bool(await cls._redis().eval(EXTEND_LOCK, 1, cls._lock_key, token, cls._lock_timeout))
+
+    @classmethod
+    async def run_pass(cls):
+        redis = cls._redis()
+        token = uuid.uuid4().hex
+        if not await redis.set(cls._lock_key, token, nx=True, ex=cls._lock_timeout):
+            return
+        tm_start = time.perf_counter()
+        try:
+            for bucket in Buckets:
+                await cls.sweep_page(bucket.value)
+                if not await cls._extend_lock(token):
+                    logger.warning("Media GC lock lost, stopping the pass")
+                    return
+            while True:
+                reaped = await cls.reap_batch()
+                if reaped:
+                    if not await cls._extend_lock(token):
+                        logger.warning("Media GC lock lost, stopping the pass")
+                        return
+                    await asyncio.sleep(reaped / settings.MEDIA_GC_RATE)
+                if reaped < cls._batch_size:
+                    break
+        finally:
+            await redis.eval(RELEASE_LOCK, 1, cls._lock_key, token)
+            cls._stats["passes"] += 1
+            cls._stats["last_pass_seconds"] = time.perf_counter() - tm_start
+
+    @classmethod
+    async def _run(cls):
+        while True:
+            try:
+                await cls.run_pass()
+            except Exception as e:
+                cls._stats["errors"] += 1
+                logger.exception(e)
+            await asyncio.sleep(cls._interval)
+
+    @classmethod
+    def start(cls):
+        cls._task = asyncio.create_task(cls._run())
+
+    @classmethod
+    async def stop(cls):
+        if cls._task is not None:
+            cls._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await cls._task
+            cls._task = None
+
+    @classmethod
+    def stats(cls) -> dict:
+        return {"grace_seconds": cls._grace.total_seconds(), "rate": settings.MEDIA_GC_RATE,
+                **cls._stats}
@@ -0,0 +1,153 @@
+import asyncio
+import contextlib
+import os
+import time
+
+from config import settings
+
+# Режим нескольких процессов включается переменной окружения до импорта
+# prometheus_client, каталог должен очищаться при старте сервиса, а не воркера
+if settings.PROMETHEUS_MULTIPROC_DIR:
+    os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", settings.PROMETHEUS_MULTIPROC_DIR)
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+from prometheus_client import (  # noqa: E402
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest,
+    multiprocess
+)
+
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Request handling time", ["method", "route"]
+)
+HTTP_REQUESTS = Counter(
+    "http_requests", "Handled requests", ["method", "route", "status"]
+)
+DB_POOL_CHECKOUT_WAIT = Histogram(
+    "db_pool_checkout_wait_seconds",
+    "Time to get a connection from the SQLAlchemy pool, without opening new connections"
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "db_pool_checked_out", "Connections taken from the pool", multiprocess_mode="livesum"
+)
+DB_QUERY_DURATION = Histogram(
+    "db_query_duration_seconds", "Query execution time", ["statement"]
+)
+PROFILE_CACHE_LOOKUPS = Counter(
+    "profile_cache_lookups", "Profile cache lookups by result", ["result"]
+)
+STORAGE_DURATION = Histogram(
+    "storage_operation_duration_seconds", "Media storage call time", ["operation"]
+)
+STORAGE_ERRORS = Counter(
+    "storage_operation_errors", "Failed media storage calls", ["operation"]
+)
+RABBIT_PUBLISH_DURATION = Histogram(
+    "rabbitmq_publish_duration_seconds", "Time to publish and get broker confirms", ["kind"]
+)
+RABBIT_PUBLISH_ERRORS = Counter(
+    "rabbitmq_publish_errors", "Failed publishes", ["kind"]
+)
+DOWNSTREAM_DURATION = Histogram(
+    "downstream_request_duration_seconds", "Call time of one attempt to a service",
+    ["service", "method"]
+)
+DOWNSTREAM_ERRORS = Counter(
+    "downstream_request_errors", "Failed attempts and rejected calls to a service",
+    ["service", "reason"]
+)
+EVENT_LOOP_LAG = Histogram(
+    "event_loop_lag_seconds", "Delay of a scheduled wake-up of the event loop", buckets=LAG_BUCKETS
+)
+
+_STATEMENTS = {"SELECT", "INSERT", "UPDATE", "DELETE", "WITH"}
+
+
+def statement_kind(statement: str) -> str:
+    """Тип запроса для метки, сам текст в метку не попадает"""
+    words = statement.lstrip()[:7].split(maxsplit=1)
+    kind = words[0].upper() if words else ""
+    return kind if kind in _STATEMENTS else "OTHER"
+
+
+def render() -> tuple[bytes, str]:
+    """Метрики в текстовом формате Prometheus, в режиме нескольких процессов - всех воркеров"""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead():
+    """Убирает gauge-значения завершившегося воркера"""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+class MetricsMiddleware:
+
+    """
+    ASGI middleware с временем обработки и статусами запросов
+
+    Метка route - шаблон пути маршрута, запросы мимо маршрутов попадают в
+    "unmatched", чтобы число рядов не зависело от присланных путей.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+        tm_start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            HTTP_REQUEST_DURATION.labels(scope["method"], path).observe(time.perf_counter() - tm_start)
+            HTTP_REQUESTS.labels(scope["method"], path, str(status)).inc()
+
+
+class EventLoopMonitor:
+
+    """
+    Задержка event loop: насколько позже заданного просыпается sleep
+
+    Большая задержка значит, что loop занят синхронной работой.
+    """
+
+    _interval = settings.METRICS_LOOP_LAG_INTERVAL
+    _task: asyncio.Task | None = None
+
+    @classmethod
+    async def _run(cls):
+        loop = asyncio.get_running_loop()
+        while True:
+            tm_start = loop.time()
+            await asyncio.sleep(cls._interval)
+            EVENT_LOOP_LAG.observe(max(0.0, loop.time() - tm_start - cls._interval))
+
+    @classmethod
+    def start(cls):
+        cls._task = asyncio.create_task(cls._run())
+
+    @classmethod
+    async def stop(cls):
+        if cls._task is not None:
+            cls._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await cls._task
+            cls._task = None
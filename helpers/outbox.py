@@ -0,0 +1,162 @@
+import asyncio
+import contextlib
+import datetime
+import logging
+
+from sqlalchemy import String, column, select, delete, func, or_, values
+from sqlalchemy.orm import aliased
+
+from config import settings
+from database.connector import async_session
+from database.models import OutboxMessages
+from helpers.publisher import Publisher, ROUTING_KEYS
+
+logger = logging.getLogger(__name__)
+
+# Пространство advisory-блокировок outbox, второй аргумент - hashtext(coalesce_key)
+COALESCE_LOCK_CLASS = 7001
+
+
+class OutboxRelay:
+
+    """
+    Пересылка сообщений из outbox_messages в RabbitMQ
+
+    Строки забираются пачками через FOR UPDATE SKIP LOCKED, поэтому воркеры
+    не мешают друг другу. Строка удаляется в той же транзакции только после
+    подтверждения брокера, при ошибке пачка будет отправлена повторно
+    (доставка at-least-once).
+
+    Сообщения с coalesce_key ждут, пока по ключу не будет новых сообщений
+    в течение окна (но не дольше max_wait), и из них отправляется только
+    последнее. Ключ забирается одним воркером за раз (advisory-блокировка
+    до конца транзакции): иначе более новое состояние, забранное другим
+    воркером, могло бы уйти раньше старого.
+    """
+
+    _batch_size = settings.OUTBOX_BATCH_SIZE
+    _interval = settings.OUTBOX_POLL_INTERVAL
+    _window = datetime.timedelta(seconds=settings.NOTIFICATION_COALESCE_WINDOW)
+    _max_wait = datetime.timedelta(seconds=settings.NOTIFICATION_COALESCE_MAX_WAIT)
+    _task: asyncio.Task | None = None
+    _stats = {"published": 0, "coalesced": 0, "batches": 0, "last_batch_size": 0,
+              "lag_seconds": 0.0, "errors": 0}
+
+    @classmethod
+    def _claim_statement(cls):
+        now = datetime.datetime.utcnow()
+        newer = aliased(OutboxMessages)
+        has_recent = (
+            select(newer.id)
+            .where(
+                newer.coalesce_key == OutboxMessages.coalesce_key,
+                newer.created_at > now - cls._window
+            )
+            .exists()
+        )
+        return (
+            select(OutboxMessages)
+            .where(
+                or_(
+                    OutboxMessages.coalesce_key.is_(None),
+                    ~has_recent,
+                    OutboxMessages.created_at <= now - cls._max_wait
+                )
+            )
+            .order_by(OutboxMessages.id)
+            .limit(cls._batch_size)
+            .with_for_update(of=OutboxMessages, skip_locked=True)
+        )
+
+    @staticmethod
+    def _lock_keys_statement(keys: list[str]):
+        """
+        Advisory-блокировки ключей уже забранных строк
+
+        Отдельный запрос: в WHERE забирающего запроса блокировка бралась бы и
+        для строк, отброшенных LIMIT или SKIP LOCKED.
+        """
+        claimed = values(column("coalesce_key", String), name="claimed_keys").data(
+            [(key,) for key in keys]
+        )
+        return select(
+            claimed.c.coalesce_key,
+            func.pg_try_advisory_xact_lock(COALESCE_LOCK_CLASS, func.hashtext(claimed.c.coalesce_key))
+        )
+
+    @staticmethod
+    def _coalesce(rows: list) -> list:
+        """Оставляет последнее сообщение по каждому coalesce_key, порядок сохраняется"""
+        latest = {}
+        for row in rows:
+            if row.coalesce_key is not None:
+                latest[row.coalesce_key] = row.id
+        return [
+            row for row in rows
+            if row.coalesce_key is None or latest[row.coalesce_key] == row.id
+        ]
+
+    @classmethod
+    async def relay_batch(cls) -> int:
+        async with async_session() as session:
+            rows = await session.execute(cls._claim_statement())
+            rows = rows.scalars().all()
+            if not rows:
+                cls._stats["lag_seconds"] = 0.0
+                return 0
+            keys = sorted({row.coalesce_key for row in rows if row.coalesce_key is not None})
+            if keys:
+                # Строки ключа, который держит другой воркер, пропускаются
+                # целиком, а не только заблокированные
+                locked = await session.execute(cls._lock_keys_statement(keys))
+                locked = {key for key, acquired in locked if acquired}
+                rows = [row for row in rows if row.coalesce_key is None or row.coalesce_key in locked]
+                if not rows:
+                    return 0
+            to_publish = cls._coalesce(rows)
+            await Publisher.publish_batch(
+                [(row.payload.encode(), ROUTING_KEYS[row.queue]) for row in to_publish]
+            )
+            await session.execute(
+                delete(OutboxMessages).filter(OutboxMessages.id.in_([row.id for row in rows]))
+            )
+            await session.commit()
+        oldest = min(row.created_at for row in rows)
+        cls._stats["lag_seconds"] = (datetime.datetime.utcnow() - oldest).total_seconds()
+        cls._stats["published"] += len(to_publish)
+        cls._stats["coalesced"] += len(rows) - len(to_publish)
+        cls._stats["batches"] += 1
+        cls._stats["last_batch_size"] = len(rows)
+        return len(rows)
+
+    @classmethod
+    async def _run(cls):
+        while True:
+            try:
+                # Полная пачка - в очереди есть еще строки, забираем сразу
+                if await cls.relay_batch() == cls._batch_size:
+                    continue
+            except Exception as e:
+                cls._stats["errors"] += 1
+                logger.exception(e)
+            await asyncio.sleep(cls._interval)
+
+    @classmethod
+    def start(cls):
+        cls._task = asyncio.create_task(cls._run())
+
+    @classmethod
+    async def stop(cls):
+        if cls._task is not None:
+            cls._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await cls._task
+            cls._task = None
+
+    @classmethod
+    def stats(cls) -> dict:
+        return {
+            "batch_size": cls._batch_size,
+            "coalesce_window": cls._window.total_seconds(),
+            **cls._stats
+        }
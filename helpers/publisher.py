@@ -1,10 +1,16 @@
+import asyncio
 import enum
-import json
+import logging
+import time
 import uuid
 
 import aio_pika
+from aio_pika.pool import Pool
 
 from config import settings
+from helpers.metrics import RABBIT_PUBLISH_DURATION, RABBIT_PUBLISH_ERRORS
+
+logger = logging.getLogger(__name__)
 
 
 def _create_message(data):
@@ -23,13 +29,114 @@ class Exchanges(enum.Enum):
     email = "smtp-service"
 
 
-async def publish_message(data, queue):
-    connection = await aio_pika.connect_robust(settings.rabbit_conn)
-    async with connection:
-        routing_key = getattr(Exchanges, queue).value
-        channel: aio_pika.abc.AbstractChannel = await connection.channel()
-        message = _create_message(data.model_dump_json().encode())
-        await channel.default_exchange.publish(
-            message,
-            routing_key=routing_key
-        )
+ROUTING_KEYS = {exchange.name: exchange.value for exchange in Exchanges}
+
+
+class Publisher:
+
+    """
+    Публикация сообщений в RabbitMQ
+
+    Одно robust-соединение на воркер и пул каналов, создаются в lifespan
+    приложения и закрываются при остановке.
+    """
+
+    _pool_size = settings.RABBIT_CHANNEL_POOL_SIZE
+    _connection: aio_pika.abc.AbstractRobustConnection | None = None
+    _channels: Pool | None = None
+    _lock = asyncio.Lock()
+    _stats = {"published": 0, "errors": 0, "in_flight": 0, "publish_seconds": 0.0}
+
+    @classmethod
+    async def connect(cls):
+        async with cls._lock:
+            if cls._channels is not None:
+                return
+            cls._connection = await aio_pika.connect_robust(settings.rabbit_conn)
+            cls._channels = Pool(cls._open_channel, max_size=cls._pool_size)
+
+    @classmethod
+    async def start(cls):
+        """Подключение при старте, при ошибке повторится при первой публикации"""
+        try:
+            await cls.connect()
+        except Exception as e:
+            logger.exception(e)
+
+    @classmethod
+    async def _open_channel(cls) -> aio_pika.abc.AbstractChannel:
+        return await cls._connection.channel()
+
+    @classmethod
+    async def close(cls):
+        if cls._channels is not None:
+            await cls._channels.close()
+            cls._channels = None
+        if cls._connection is not None:
+            await cls._connection.close()
+            cls._connection = None
+
+    @classmethod
+    async def publish(cls, body: bytes, routing_key: str):
+        if cls._channels is None:
+            await cls.connect()
+        tm_start = time.perf_counter()
+        cls._stats["in_flight"] += 1
+        try:
+            async with cls._channels.acquire() as channel:
+                await channel.default_exchange.publish(
+                    _create_message(body),
+                    routing_key=routing_key
+                )
+            cls._stats["published"] += 1
+        except Exception:
+            cls._stats["errors"] += 1
+            RABBIT_PUBLISH_ERRORS.labels("single").inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - tm_start
+            cls._stats["in_flight"] -= 1
+            cls._stats["publish_seconds"] += elapsed
+            RABBIT_PUBLISH_DURATION.labels("single").observe(elapsed)
+
+    @classmethod
+    async def publish_batch(cls, messages: list[tuple[bytes, str]]):
+        """
+        Публикация пачки сообщений через один канал
+
+        Сообщения уходят в канал по порядку, подтверждения брокера ожидаются
+        одновременно.
+        """
+        if cls._channels is None:
+            await cls.connect()
+        tm_start = time.perf_counter()
+        cls._stats["in_flight"] += len(messages)
+        try:
+            async with cls._channels.acquire() as channel:
+                await asyncio.gather(
+                    *[
+                        channel.default_exchange.publish(
+                            _create_message(body),
+                            routing_key=routing_key
+                        )
+                        for body, routing_key in messages
+                    ]
+                )
+            cls._stats["published"] += len(messages)
+        except Exception:
+            cls._stats["errors"] += 1
+            RABBIT_PUBLISH_ERRORS.labels("batch").inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - tm_start
+            cls._stats["in_flight"] -= len(messages)
+            cls._stats["publish_seconds"] += elapsed
+            RABBIT_PUBLISH_DURATION.labels("batch").observe(elapsed)
+
+    @classmethod
+    def stats(cls) -> dict:
+        return {
+            "connected": cls._connection is not None and not cls._connection.is_closed,
+            "pool_size": cls._pool_size,
+            **cls._stats,
+        }
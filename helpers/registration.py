@@ -0,0 +1,267 @@
+import asyncio
+import contextlib
+import json
+import logging
+
+from fastapi_cache import FastAPICache
+
+from config import settings
+from endpoints.dto import UserCreateModel
+from helpers.cross_service import CrossService
+from helpers.exceptions import CircuitOpenError, DownstreamError
+
+logger = logging.getLogger(__name__)
+
+
+class CommunityRegistrations:
+
+    """
+    Пакетная регистрация новых пользователей в community-сервисе
+
+    Регистрации копятся в ограниченной очереди и уходят пачкой, когда набрано
+    COMMUNITY_BATCH_SIZE записей или прошло COMMUNITY_BATCH_WINDOW секунд с
+    первой записи пачки. Если у сервиса нет пакетного эндпоинта (404/405),
+    пачка отправляется одиночными запросами, не более
+    COMMUNITY_FALLBACK_CONCURRENCY одновременно.
+
+    Регистрации, не отправленные из-за недоступности сервиса (ошибки после
+    повторов, открытый circuit breaker), откладываются в список Redis и
+    повторяются с растущей задержкой от COMMUNITY_RETRY_INTERVAL до
+    COMMUNITY_RETRY_MAX_INTERVAL, в том числе после перезапуска: пока пачки
+    уходят, список разбирается без пауз. Ответ 4xx считается окончательным.
+
+    Заполненная очередь задерживает submit, а не теряет записи. При остановке
+    очередь дочищается до конца.
+    """
+
+    _batch_size = settings.COMMUNITY_BATCH_SIZE
+    _window = settings.COMMUNITY_BATCH_WINDOW
+    _retry_key = "community-registrations:retry"
+    _queue: asyncio.Queue | None = None
+    _task: asyncio.Task | None = None
+    _retry_task: asyncio.Task | None = None
+    _draining: asyncio.Task | None = None
+    _stopping = False
+    _putting = 0
+    _batch_supported: bool | None = None
+    _stats = {"queued": 0, "sent": 0, "failed": 0, "rejected": 0, "parked": 0, "retried": 0,
+              "batches": 0, "single_calls": 0}
+
+    @classmethod
+    def _redis(cls):
+        return FastAPICache.get_backend().redis
+
+    @classmethod
+    async def submit(cls, _id: str, user: UserCreateModel):
+        payload = CrossService.registration_payload(_id, user)
+        if cls._task is None or cls._stopping:
+            await cls._deliver([payload])
+            return
+        cls._stats["queued"] += 1
+        # stop() ждет завершения put, чтобы запись не оказалась за меткой остановки
+        cls._putting += 1
+        try:
+            await cls._queue.put(payload)
+        finally:
+            cls._putting -= 1
+
+    @classmethod
+    async def _collect(cls) -> tuple[list[dict], bool]:
+        """Следующая пачка и признак остановки"""
+        first = await cls._queue.get()
+        if first is None:
+            return [], True
+        batch = [first]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + cls._window
+        while len(batch) < cls._batch_size:
+            if cls._queue.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(cls._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                item = cls._queue.get_nowait()
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    @classmethod
+    async def _send_batch(cls, batch: list[dict]) -> list[dict] | None:
+        """
+        Неотправленные регистрации, которые нужно повторить
+
+        None, если пакетный эндпоинт недоступен и нужна отправка по одному.
+        """
+        try:
+            response = await CrossService.community.request(
+                "POST", settings.COMMUNITY_BATCH_PATH, json=batch
+            )
+        except (CircuitOpenError, DownstreamError) as e:
+            logger.error(f"Error while adding users to community service: {e}")
+            return batch
+        if response.status_code in (404, 405):
+            logger.warning("Community service has no batch registration, sending one by one")
+            cls._batch_supported = False
+            return None
+        cls._batch_supported = True
+        if response.is_success:
+            cls._stats["sent"] += len(batch)
+        else:
+            logger.error(f"Batch registration rejected: {response.status_code} {response.text}")
+            cls._stats["rejected"] += len(batch)
+        return []
+
+    @classmethod
+    async def _send_single(cls, batch: list[dict]) -> list[dict]:
+        semaphore = asyncio.Semaphore(settings.COMMUNITY_FALLBACK_CONCURRENCY)
+        failed = []
+
+        async def send(payload):
+            try:
+                async with semaphore:
+                    response = await CrossService.community.request("POST", "/register", json=payload)
+            except (CircuitOpenError, DownstreamError) as e:
+                logger.error(f"Error while adding user to community service: {e}")
+                failed.append(payload)
+                return
+            if response.is_success:
+                cls._stats["sent"] += 1
+            else:
+                logger.error(f"Registration rejected: {response.status_code} {response.text}")
+                cls._stats["rejected"] += 1
+
+        cls._stats["single_calls"] += len(batch)
+        await asyncio.gather(*[send(payload) for payload in batch])
+        return failed
+
+    @classmethod
+    async def send(cls, batch: list[dict]) -> list[dict]:
+        """Отправка пачки, возвращает регистрации для повтора"""
+        cls._stats["batches"] += 1
+        if cls._batch_supported is not False:
+            failed = await cls._send_batch(batch)
+            if failed is not None:
+                return failed
+        return await cls._send_single(batch)
+
+    @classmethod
+    async def _park(cls, batch: list[dict]):
+        try:
+            await cls._redis().rpush(cls._retry_key, *[json.dumps(payload) for payload in batch])
+            cls._stats["parked"] += len(batch)
+        except Exception as e:
+            cls._stats["failed"] += len(batch)
+            logger.error(
+                f"Community registrations lost for {[payload['id'] for payload in batch]}: {e}"
+            )
+
+    @classmethod
+    async def _deliver(cls, batch: list[dict]):
+        try:
+            failed = await cls.send(batch)
+        except Exception as e:
+            logger.exception(e)
+            failed = batch
+        if failed:
+            await cls._park(failed)
+
+    @classmethod
+    async def _run(cls):
+        stopping = False
+        while not stopping:
+            batch, stopping = await cls._collect()
+            if batch:
+                await cls._deliver(batch)
+
+    @classmethod
+    async def retry_parked(cls) -> int | None:
+        """
+        Повтор одной пачки отложенных регистраций
+
+        Возвращает число взятых из списка записей, None - если сервис еще недоступен.
+        """
+        items = await cls._redis().lpop(cls._retry_key, cls._batch_size)
+        if not items:
+            return 0
+        batch = [json.loads(item) for item in items]
+        cls._stats["retried"] += len(batch)
+        try:
+            failed = await cls.send(batch)
+        except Exception as e:
+            logger.exception(e)
+            failed = batch
+        if failed:
+            await cls._park(failed)
+            return None
+        return len(batch)
+
+    @classmethod
+    async def _drain(cls) -> bool:
+        """Повтор отложенных пачек подряд, пока они уходят, False - если сервис недоступен"""
+        try:
+            while not cls._stopping:
+                retried = await cls.retry_parked()
+                if retried is None:
+                    return False
+                if not retried:
+                    break
+            return True
+        except Exception as e:
+            logger.exception(e)
+            return False
+
+    @classmethod
+    async def _retry(cls):
+        attempt = 0
+        while True:
+            await asyncio.sleep(min(
+                settings.COMMUNITY_RETRY_MAX_INTERVAL,
+                settings.COMMUNITY_RETRY_INTERVAL * 2 ** attempt
+            ))
+            # Отмена не прерывает начатый повтор: взятые из списка записи
+            # потерялись бы, stop() дожидается его сам
+            cls._draining = asyncio.create_task(cls._drain())
+            attempt = 0 if await asyncio.shield(cls._draining) else attempt + 1
+
+    @classmethod
+    def start(cls):
+        cls._queue = asyncio.Queue(maxsize=settings.COMMUNITY_QUEUE_SIZE)
+        cls._task = asyncio.create_task(cls._run())
+        cls._retry_task = asyncio.create_task(cls._retry())
+
+    @classmethod
+    async def stop(cls):
+        """Отправляет все накопленные регистрации и останавливает отправителя"""
+        if cls._task is None:
+            return
+        # Новые submit отправляют сами, ожидающие put дописываются в очередь
+        # до метки остановки, пока отправитель еще разбирает ее
+        cls._stopping = True
+        while cls._putting:
+            await asyncio.sleep(0.01)
+        await cls._queue.put(None)
+        await cls._task
+        cls._task = None
+        if cls._retry_task is not None:
+            cls._retry_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await cls._retry_task
+            cls._retry_task = None
+        # Повтор заканчивает текущую пачку и останавливается по _stopping
+        if cls._draining is not None:
+            await cls._draining
+            cls._draining = None
+        cls._stopping = False
+
+    @classmethod
+    def stats(cls) -> dict:
+        return {
+            "pending": cls._queue.qsize() if cls._queue is not None else 0,
+            "batch_supported": cls._batch_supported,
+            **cls._stats,
+        }
@@ -1,18 +1,42 @@
+import asyncio
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Annotated
 
 from passlib.context import CryptContext
 from fastapi.security import OAuth2PasswordBearer
 from fastapi import status, HTTPException, Depends
 from jose import jwt, JWTError
+from pydantic import ValidationError
 
 from config import settings
 from endpoints.dto import TokenData
+from helpers.lru import TTLCache
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=settings.BCRYPT_ROUNDS,
+)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/token")
 
 
 class Hasher:
+
+    """
+    Хэширование паролей
+
+    Bcrypt выполняется в отдельном пуле потоков (bcrypt отпускает GIL), чтобы
+    не блокировать event loop воркера.
+    """
+
+    _pool_size = settings.HASHER_POOL_SIZE
+    _executor: ThreadPoolExecutor | None = None
+    _lock = threading.Lock()
+    _stats = {"queued": 0, "active": 0, "completed": 0, "busy_seconds": 0.0}
+
     @staticmethod
     def verify_password(plain_password: str, hasher_password: str) -> bool:
         return pwd_context.verify(plain_password, hasher_password)
@@ -21,14 +45,64 @@ class Hasher:
     def get_hash_password(password: str) -> str:
         return pwd_context.hash(password)
 
+    @classmethod
+    def _get_executor(cls) -> ThreadPoolExecutor:
+        if cls._executor is None:
+            cls._executor = ThreadPoolExecutor(
+                max_workers=cls._pool_size, thread_name_prefix="hasher"
+            )
+        return cls._executor
+
+    @classmethod
+    def _tracked(cls, func, *args):
+        with cls._lock:
+            cls._stats["queued"] -= 1
+            cls._stats["active"] += 1
+        tm_start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            with cls._lock:
+                cls._stats["active"] -= 1
+                cls._stats["completed"] += 1
+                cls._stats["busy_seconds"] += time.perf_counter() - tm_start
+
+    @classmethod
+    async def _run(cls, func, *args):
+        with cls._lock:
+            cls._stats["queued"] += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(cls._get_executor(), cls._tracked, func, *args)
+
+    @classmethod
+    async def hash_password(cls, password: str) -> str:
+        return await cls._run(pwd_context.hash, password)
+
+    @classmethod
+    def stats(cls) -> dict:
+        with cls._lock:
+            return {"pool_size": cls._pool_size, "rounds": settings.BCRYPT_ROUNDS, **cls._stats}
+
+    @classmethod
+    def shutdown(cls):
+        if cls._executor is not None:
+            cls._executor.shutdown(wait=True)
+            cls._executor = None
+
 
 class Authenticator:
     __secret_key = settings.SECRET_KEY
     __algorithm = settings.ALGORITHM
     __expire_time = settings.EXPIRE_TIME
+    # Проверенные токены, ключ - sha256 токена. Запись живет не дольше exp
+    _verified = TTLCache(maxsize=settings.TOKEN_CACHE_SIZE, ttl=settings.TOKEN_CACHE_TTL)
 
     @classmethod
-    def get_user_by_token(cls, token: Annotated[str, Depends(oauth2_scheme)]):
+    async def get_user_by_token(cls, token: Annotated[str, Depends(oauth2_scheme)]):
+        digest = hashlib.sha256(token.encode()).digest()
+        user = cls._verified.get(digest)
+        if user is not None:
+            return user
         credentials_exceptions = HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Could not validate credentials",
@@ -40,6 +114,16 @@ class Authenticator:
                 cls.__secret_key,
                 algorithms=[cls.__algorithm]
             )
-            return TokenData.model_dump(payload)
-        except JWTError:
+            user = TokenData.model_validate(payload)
+        except (JWTError, ValidationError):
             raise credentials_exceptions
+        expires_at = payload.get("exp")
+        cls._verified.set(
+            digest, user,
+            ttl=None if expires_at is None else expires_at - time.time()
+        )
+        return user
+
+    @classmethod
+    def stats(cls) -> dict:
+        return cls._verified.stats()
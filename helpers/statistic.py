@@ -0,0 +1,102 @@
+import asyncio
+import contextlib
+import logging
+import uuid
+
+from fastapi_cache import FastAPICache
+from redis.exceptions import ResponseError
+
+from config import settings
+from database.interface import DatabaseInterface
+
+logger = logging.getLogger(__name__)
+
+
+class StatisticAggregator:
+
+    """
+    Отложенная запись статистики аккаунтов
+
+    Изменения счетчиков атомарно накапливаются в hash Redis (HINCRBY) и
+    периодически переносятся в account_statistics одним пакетным UPDATE
+    вида col = col + delta.
+    """
+
+    _key = "statistic:deltas"
+    _interval = settings.STATISTIC_FLUSH_INTERVAL
+    _task: asyncio.Task | None = None
+
+    @classmethod
+    def _redis(cls):
+        return FastAPICache.get_backend().redis
+
+    @classmethod
+    async def add(cls, deltas: list[tuple[str, str, int]]):
+        """Принимает список (user_id, field, delta)"""
+        async with cls._redis().pipeline(transaction=False) as pipe:
+            for user_id, field, delta in deltas:
+                if delta:
+                    pipe.hincrby(cls._key, f"{user_id}:{field}", delta)
+            await pipe.execute()
+
+    @classmethod
+    async def flush(cls) -> int:
+        redis = cls._redis()
+        # Забираем накопленное под уникальным ключом, новые изменения
+        # продолжают копиться в основном ключе
+        batch_key = f"{cls._key}:{uuid.uuid4().hex}"
+        try:
+            await redis.rename(cls._key, batch_key)
+        except ResponseError:
+            return 0
+        deltas = await redis.hgetall(batch_key)
+        changes = {}
+        for member, delta in list(deltas.items()):
+            user_id, _, field = member.rpartition(":")
+            try:
+                user_id = str(uuid.UUID(user_id))
+                delta = int(delta)
+            except ValueError:
+                user_id = None
+            if user_id is None or field not in ("events", "friends"):
+                # Битая запись не должна блокировать всю пачку при повторах
+                logger.error(f"Dropping malformed statistic delta {member!r}: {delta!r}")
+                del deltas[member]
+                continue
+            changes.setdefault(user_id, {"events": 0, "friends": 0})[field] += delta
+        try:
+            await DatabaseInterface.apply_statistic_deltas(changes)
+        except Exception:
+            async with redis.pipeline(transaction=False) as pipe:
+                for member, delta in deltas.items():
+                    pipe.hincrby(cls._key, member, int(delta))
+                pipe.delete(batch_key)
+                await pipe.execute()
+            raise
+        await redis.delete(batch_key)
+        return len(changes)
+
+    @classmethod
+    async def _run(cls):
+        while True:
+            await asyncio.sleep(cls._interval)
+            try:
+                await cls.flush()
+            except Exception as e:
+                logger.exception(e)
+
+    @classmethod
+    def start(cls):
+        cls._task = asyncio.create_task(cls._run())
+
+    @classmethod
+    async def stop(cls):
+        if cls._task is not None:
+            cls._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await cls._task
+            cls._task = None
+        try:
+            await cls.flush()
+        except Exception as e:
+            logger.exception(e)
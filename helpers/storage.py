@@ -0,0 +1,413 @@
+import abc
+import datetime
+import io
+import logging
+import os
+import shutil
+import threading
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class StoredObject:
+    key: str
+    size: int
+    modified: datetime.datetime
+
+
+class StorageBackend(abc.ABC):
+
+    """
+    Хранилище объектов, с которым работает CloudMediaStorageAdapter
+
+    Методы блокирующие, адаптер вызывает их в пуле потоков. Загрузка из
+    потока выполняется частями: create_multipart, upload_part по порядку,
+    complete_multipart или abort_multipart.
+    """
+
+    name: str
+
+    @abc.abstractmethod
+    def put(self, bucket: str, key: str, body: bytes, content_type: str | None = None):
+        ...
+
+    @abc.abstractmethod
+    def create_multipart(self, bucket: str, key: str) -> str:
+        ...
+
+    @abc.abstractmethod
+    def upload_part(self, bucket: str, key: str, upload_id: str, number: int, body: bytes) -> str:
+        ...
+
+    @abc.abstractmethod
+    def complete_multipart(self, bucket: str, key: str, upload_id: str, parts: list[dict]):
+        ...
+
+    @abc.abstractmethod
+    def abort_multipart(self, bucket: str, key: str, upload_id: str):
+        ...
+
+    @abc.abstractmethod
+    def copy(self, bucket: str, source_key: str, key: str):
+        ...
+
+    @abc.abstractmethod
+    def delete_many(self, bucket: str, keys: list[str]) -> list[str]:
+        """Удаление объектов, возвращает ключи, которые удалить не удалось"""
+
+    @abc.abstractmethod
+    def stat(self, bucket: str, key: str) -> StoredObject | None:
+        ...
+
+    def exists(self, bucket: str, key: str) -> bool:
+        return self.stat(bucket, key) is not None
+
+    @abc.abstractmethod
+    def open(self, bucket: str, key: str) -> BinaryIO:
+        """Объект для чтения частями, если объекта нет - FileNotFoundError"""
+
+    @abc.abstractmethod
+    def list(self, bucket: str, start_after: str | None, limit: int) -> tuple[list[StoredObject], bool]:
+        """Объекты по возрастанию ключа после start_after и признак, что есть еще"""
+
+    @abc.abstractmethod
+    def presign_post(self, bucket: str, key: str, max_size: int, expires: int) -> dict:
+        """Форма POST для загрузки файла клиентом напрямую, url и fields"""
+
+
+class S3StorageBackend(StorageBackend):
+
+    """
+    S3-совместимое хранилище через boto3
+
+    Клиенты создаются при первом обращении, поэтому импорт и старт сервиса
+    не зависят от доступности хранилища.
+    """
+
+    name = "s3"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._client = None
+        self._presigner = None
+
+    def _build(self, endpoint_url: str):
+        return boto3.client(
+            "s3", endpoint_url=endpoint_url, region_name=settings.S3_REGION,
+            aws_access_key_id=settings.SELECTEL_S3_ACCESS_KEY,
+            aws_secret_access_key=settings.SELECTEL_S3_SECRET_KEY,
+            config=Config(
+                max_pool_connections=settings.S3_MAX_CONCURRENCY,
+                signature_version="s3v4",
+                s3={"addressing_style": settings.S3_ADDRESSING_STYLE}
+            )
+        )
+
+    @property
+    def client(self):
+        if self._client is None:
+            # Создание клиента boto3 из нескольких потоков сразу не потокобезопасно
+            with self._lock:
+                if self._client is None:
+                    self._client = self._build(settings.S3_ENDPOINT_URL)
+        return self._client
+
+    @property
+    def presigner(self):
+        # Подписанные ссылки должны указывать на адрес, доступный клиенту
+        if settings.S3_PUBLIC_ENDPOINT_URL is None:
+            return self.client
+        if self._presigner is None:
+            with self._lock:
+                if self._presigner is None:
+                    self._presigner = self._build(settings.S3_PUBLIC_ENDPOINT_URL)
+        return self._presigner
+
+    def put(self, bucket, key, body, content_type=None):
+        extra = {"ContentType": content_type} if content_type else {}
+        self.client.put_object(Bucket=bucket, Key=key, Body=body, **extra)
+
+    def create_multipart(self, bucket, key):
+        return self.client.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+
+    def upload_part(self, bucket, key, upload_id, number, body):
+        return self.client.upload_part(
+            Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=body
+        )["ETag"]
+
+    def complete_multipart(self, bucket, key, upload_id, parts):
+        self.client.complete_multipart_upload(
+            Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts}
+        )
+
+    def abort_multipart(self, bucket, key, upload_id):
+        self.client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+
+    def copy(self, bucket, source_key, key):
+        self.client.copy_object(
+            Bucket=bucket, Key=key, CopySource={"Bucket": bucket, "Key": source_key}
+        )
+
+    def delete_many(self, bucket, keys):
+        response = self.client.delete_objects(
+            Bucket=bucket, Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True}
+        )
+        failed = []
+        for error in response.get("Errors", []):
+            logger.error(f"Failed to delete {bucket}/{error['Key']}: {error.get('Code')}")
+            failed.append(error["Key"])
+        return failed
+
+    @staticmethod
+    def _not_found(e) -> bool:
+        return e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound")
+
+    def stat(self, bucket, key):
+        try:
+            head = self.client.head_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if self._not_found(e):
+                return None
+            raise
+        return StoredObject(key, head["ContentLength"], head["LastModified"])
+
+    def open(self, bucket, key):
+        try:
+            return self.client.get_object(Bucket=bucket, Key=key)["Body"]
+        except ClientError as e:
+            if self._not_found(e):
+                raise FileNotFoundError(f"{bucket}/{key}") from None
+            raise
+
+    def list(self, bucket, start_after, limit):
+        kwargs = {"StartAfter": start_after} if start_after else {}
+        page = self.client.list_objects_v2(Bucket=bucket, MaxKeys=limit, **kwargs)
+        objects = [
+            StoredObject(obj["Key"], obj["Size"], obj["LastModified"])
+            for obj in page.get("Contents", [])
+        ]
+        return objects, bool(page.get("IsTruncated"))
+
+    def presign_post(self, bucket, key, max_size, expires):
+        form = self.presigner.generate_presigned_post(
+            Bucket=bucket,
+            Key=key,
+            Conditions=[["content-length-range", 1, max_size]],
+            ExpiresIn=expires,
+        )
+        return {"url": form["url"], "fields": form["fields"]}
+
+
+class MemoryStorageBackend(StorageBackend):
+
+    """
+    Хранилище в памяти процесса для нагрузочных замеров и локального запуска
+
+    Данные не переживают перезапуск и не разделяются между воркерами.
+    Подписанная форма указывает на STORAGE_PRESIGN_URL, принимать такие
+    загрузки сервис не умеет.
+    """
+
+    name = "memory"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._objects: dict[str, dict[str, tuple[bytes, datetime.datetime]]] = {}
+        self._uploads: dict[str, dict[int, bytes]] = {}
+
+    def put(self, bucket, key, body, content_type=None):
+        with self._lock:
+            self._objects.setdefault(bucket, {})[key] = (
+                bytes(body), datetime.datetime.now(datetime.timezone.utc)
+            )
+
+    def create_multipart(self, bucket, key):
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self._uploads[upload_id] = {}
+        return upload_id
+
+    def upload_part(self, bucket, key, upload_id, number, body):
+        with self._lock:
+            self._uploads[upload_id][number] = bytes(body)
+        return str(number)
+
+    def complete_multipart(self, bucket, key, upload_id, parts):
+        with self._lock:
+            uploaded = self._uploads.pop(upload_id)
+        self.put(bucket, key, b"".join(uploaded[part["PartNumber"]] for part in parts))
+
+    def abort_multipart(self, bucket, key, upload_id):
+        with self._lock:
+            self._uploads.pop(upload_id, None)
+
+    def copy(self, bucket, source_key, key):
+        with self._lock:
+            objects = self._objects.get(bucket, {})
+            if source_key not in objects:
+                raise FileNotFoundError(f"{bucket}/{source_key}")
+            body, _ = objects[source_key]
+            objects[key] = (body, datetime.datetime.now(datetime.timezone.utc))
+
+    def delete_many(self, bucket, keys):
+        with self._lock:
+            objects = self._objects.get(bucket, {})
+            for key in keys:
+                objects.pop(key, None)
+        return []
+
+    def stat(self, bucket, key):
+        with self._lock:
+            stored = self._objects.get(bucket, {}).get(key)
+        if stored is None:
+            return None
+        return StoredObject(key, len(stored[0]), stored[1])
+
+    def open(self, bucket, key):
+        with self._lock:
+            stored = self._objects.get(bucket, {}).get(key)
+        if stored is None:
+            raise FileNotFoundError(f"{bucket}/{key}")
+        return io.BytesIO(stored[0])
+
+    def list(self, bucket, start_after, limit):
+        with self._lock:
+            items = sorted(self._objects.get(bucket, {}).items())
+        objects = [
+            StoredObject(key, len(body), modified)
+            for key, (body, modified) in items
+            if start_after is None or key > start_after
+        ]
+        return objects[:limit], len(objects) > limit
+
+    def presign_post(self, bucket, key, max_size, expires):
+        return {"url": f"{settings.STORAGE_PRESIGN_URL}/{bucket}", "fields": {"key": key}}
+
+
+class LocalStorageBackend(StorageBackend):
+
+    """
+    Хранилище в каталоге STORAGE_LOCAL_PATH, бакет - подкаталог
+
+    Запись атомарная: файл пишется во временный и переименовывается. Части
+    незавершенных загрузок лежат в .multipart вне бакетов.
+    """
+
+    name = "local"
+
+    def __init__(self, root: str):
+        self._root = Path(root).resolve()
+        self._multipart = self._root / ".multipart"
+
+    def _path(self, bucket: str, key: str) -> Path:
+        path = (self._root / bucket / key).resolve()
+        if not path.is_relative_to(self._root / bucket):
+            raise ValueError(f"Invalid key: {key}")
+        return path
+
+    def _write(self, path: Path, chunks):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp = path.with_name(f".{path.name}.{uuid.uuid4().hex}")
+        try:
+            with open(temp, "wb") as file_:
+                for chunk in chunks:
+                    if isinstance(chunk, Path):
+                        with open(chunk, "rb") as part:
+                            shutil.copyfileobj(part, file_)
+                    else:
+                        file_.write(chunk)
+            os.replace(temp, path)
+        except BaseException:
+            temp.unlink(missing_ok=True)
+            raise
+
+    def put(self, bucket, key, body, content_type=None):
+        self._write(self._path(bucket, key), [body])
+
+    def create_multipart(self, bucket, key):
+        upload_id = uuid.uuid4().hex
+        (self._multipart / upload_id).mkdir(parents=True)
+        return upload_id
+
+    def upload_part(self, bucket, key, upload_id, number, body):
+        (self._multipart / upload_id / str(number)).write_bytes(body)
+        return str(number)
+
+    def complete_multipart(self, bucket, key, upload_id, parts):
+        directory = self._multipart / upload_id
+        self._write(
+            self._path(bucket, key),
+            [directory / str(part["PartNumber"]) for part in parts]
+        )
+        shutil.rmtree(directory, ignore_errors=True)
+
+    def abort_multipart(self, bucket, key, upload_id):
+        shutil.rmtree(self._multipart / upload_id, ignore_errors=True)
+
+    def copy(self, bucket, source_key, key):
+        self._write(self._path(bucket, key), [self._path(bucket, source_key)])
+
+    def delete_many(self, bucket, keys):
+        failed = []
+        for key in keys:
+            try:
+                self._path(bucket, key).unlink(missing_ok=True)
+            except (OSError, ValueError) as e:
+                logger.error(f"Failed to delete {bucket}/{key}: {e}")
+                failed.append(key)
+        return failed
+
+    def _stored(self, path: Path, key: str) -> StoredObject:
+        stat = path.stat()
+        return StoredObject(
+            key, stat.st_size,
+            datetime.datetime.fromtimestamp(stat.st_mtime, datetime.timezone.utc)
+        )
+
+    def stat(self, bucket, key):
+        path = self._path(bucket, key)
+        if not path.is_file():
+            return None
+        return self._stored(path, key)
+
+    def open(self, bucket, key):
+        return open(self._path(bucket, key), "rb")
+
+    def list(self, bucket, start_after, limit):
+        directory = self._root / bucket
+        if not directory.is_dir():
+            return [], False
+        keys = sorted(
+            path.relative_to(directory).as_posix()
+            for path in directory.rglob("*")
+            if path.is_file() and not path.name.startswith(".")
+        )
+        keys = [key for key in keys if start_after is None or key > start_after]
+        objects = [self._stored(directory / key, key) for key in keys[:limit]]
+        return objects, len(keys) > limit
+
+    def presign_post(self, bucket, key, max_size, expires):
+        return {"url": f"{settings.STORAGE_PRESIGN_URL}/{bucket}", "fields": {"key": key}}
+
+
+def create_backend(name: str | None = None) -> StorageBackend:
+    """Хранилище, выбранное в STORAGE_BACKEND"""
+    name = name or settings.STORAGE_BACKEND
+    if name == "s3":
+        return S3StorageBackend()
+    if name == "local":
+        return LocalStorageBackend(settings.STORAGE_LOCAL_PATH)
+    if name == "memory":
+        return MemoryStorageBackend()
+    raise ValueError(f"Unknown storage backend: {name}")
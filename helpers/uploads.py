@@ -0,0 +1,95 @@
+from typing import AsyncIterator
+
+from fastapi import Request
+from multipart.multipart import MultipartParser, parse_options_header
+
+from helpers.exceptions import UploadTooLargeError, WrongArgumentsError
+
+
+async def stream_file(request: Request, field_name: str, max_size: int) -> AsyncIterator[bytes]:
+    """
+    Содержимое файла из multipart/form-data по мере получения тела запроса
+
+    Тело разбирается потоково и в память целиком не читается. Остальные поля
+    формы пропускаются. Если файл больше max_size байт, загрузка прерывается
+    с UploadTooLargeError, если тело оборвалось до конца части с файлом - с
+    WrongArgumentsError.
+    """
+    content_length = request.headers.get("content-length")
+    if content_length is not None and content_length.isdigit() and int(content_length) > max_size:
+        raise UploadTooLargeError(f"File is larger than {max_size} bytes")
+    _, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if boundary is None:
+        raise WrongArgumentsError("Expected multipart/form-data with a boundary")
+
+    state = {"header_name": b"", "header_value": b"", "disposition": b"",
+             "in_file": False, "found": False, "complete": False}
+    pending: list[bytes] = []
+
+    def on_part_begin():
+        state["disposition"] = b""
+        state["in_file"] = False
+
+    def on_header_field(data, start, end):
+        state["header_name"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        state["header_value"] += data[start:end]
+
+    def on_header_end():
+        if state["header_name"].lower() == b"content-disposition":
+            state["disposition"] = state["header_value"]
+        state["header_name"] = b""
+        state["header_value"] = b""
+
+    def on_headers_finished():
+        _, options = parse_options_header(state["disposition"])
+        state["in_file"] = (
+            not state["found"]
+            and options.get(b"name") == field_name.encode()
+            and b"filename" in options
+        )
+        if state["in_file"]:
+            state["found"] = True
+
+    def on_part_data(data, start, end):
+        if state["in_file"]:
+            pending.append(data[start:end])
+
+    def on_part_end():
+        if state["in_file"]:
+            state["complete"] = True
+            state["in_file"] = False
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+    received = 0
+    async for chunk in request.stream():
+        parser.write(chunk)
+        for data in pending:
+            received += len(data)
+            if received > max_size:
+                raise UploadTooLargeError(f"File is larger than {max_size} bytes")
+            yield data
+        pending.clear()
+    parser.finalize()
+    if not state["found"]:
+        raise WrongArgumentsError(f"File field '{field_name}' is missing")
+    if not state["complete"]:
+        raise WrongArgumentsError(f"File field '{field_name}' is incomplete")
+
+
+async def read_file(request: Request, field_name: str, max_size: int) -> bytes:
+    """Файл из multipart/form-data целиком, с тем же ограничением размера"""
+    data = bytearray()
+    async for chunk in stream_file(request, field_name, max_size):
+        data += chunk
+    return bytes(data)
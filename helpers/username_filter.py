@@ -0,0 +1,160 @@
+import asyncio
+import hashlib
+import logging
+import math
+
+from fastapi_cache import FastAPICache
+from redis.exceptions import RedisError
+from sqlalchemy import select
+
+from config import settings
+from database.connector import async_session
+from database.models import UsersAccounts
+
+logger = logging.getLogger(__name__)
+
+# Уменьшение счетчиков, только если фильтр построен: во время build() имя
+# могло еще не попасть в фильтр, и вычитание задело бы чужие счетчики
+REMOVE_IF_READY = """
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    return 0
+end
+redis.call('BITFIELD', KEYS[1], unpack(ARGV))
+return 1
+"""
+
+
+class UsernameFilter:
+
+    """
+    Вероятностный фильтр занятых имен пользователей
+
+    Counting Bloom filter из 4-битных счетчиков (BITFIELD) в Redis, общий для
+    всех воркеров. Отрицательный ответ точен, положительный нужно проверять
+    запросом в БД. Счетчики позволяют удалять имена из фильтра.
+    """
+
+    _key = "username-filter"
+    _ready_key = "username-filter:ready"
+    _lock_key = "username-filter:lock"
+    _capacity = settings.USERNAME_FILTER_CAPACITY
+    _error_rate = settings.USERNAME_FILTER_ERROR_RATE
+    _size = math.ceil(-_capacity * math.log(_error_rate) / math.log(2) ** 2)
+    _hashes = max(1, round(_size / _capacity * math.log(2)))
+    _chunk = 1000
+    _tasks: set[asyncio.Task] = set()
+
+    @classmethod
+    def _redis(cls):
+        return FastAPICache.get_backend().redis
+
+    @classmethod
+    def _offsets(cls, username: str) -> list[str]:
+        digest = hashlib.blake2b(username.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [f"#{(h1 + i * h2) % cls._size}" for i in range(cls._hashes)]
+
+    @classmethod
+    def _incrby_args(cls, username: str, increment: int) -> list:
+        args = ["OVERFLOW", "SAT"]
+        for offset in cls._offsets(username):
+            args += ["INCRBY", "u4", offset, increment]
+        return args
+
+    @classmethod
+    def _incrby(cls, username: str, increment: int) -> list:
+        return ["BITFIELD", cls._key, *cls._incrby_args(username, increment)]
+
+    @classmethod
+    async def might_contain(cls, username: str) -> bool:
+        command = ["BITFIELD", cls._key]
+        for offset in cls._offsets(username):
+            command += ["GET", "u4", offset]
+        try:
+            async with cls._redis().pipeline(transaction=False) as pipe:
+                pipe.exists(cls._ready_key)
+                pipe.execute_command(*command)
+                ready, counters = await pipe.execute()
+        except RedisError as e:
+            logger.exception(e)
+            return True
+        if not ready:
+            return True
+        return all(counters)
+
+    @classmethod
+    async def add(cls, username: str):
+        """
+        Добавление занятого имени
+
+        Если добавить не удалось, фильтр сбрасывается: иначе имя навсегда
+        считалось бы свободным. Пока фоновый build() строит фильтр заново,
+        проверки идут в БД.
+        """
+        try:
+            await cls._update([username], 1)
+        except RedisError as e:
+            logger.exception(e)
+            try:
+                await cls._redis().delete(cls._ready_key)
+            except RedisError as e:
+                logger.exception(e)
+            cls._rebuild()
+
+    @classmethod
+    async def remove(cls, username: str):
+        # Лишнее имя в фильтре дает только ложноположительный ответ
+        try:
+            await cls._redis().eval(
+                REMOVE_IF_READY, 2, cls._key, cls._ready_key, *cls._incrby_args(username, -1)
+            )
+        except RedisError as e:
+            logger.exception(e)
+
+    @classmethod
+    def _rebuild(cls):
+        """Фоновое построение фильтра после сброса"""
+        async def rebuild():
+            try:
+                await cls.build()
+            except Exception as e:
+                logger.exception(e)
+
+        task = asyncio.create_task(rebuild())
+        cls._tasks.add(task)
+        task.add_done_callback(cls._tasks.discard)
+
+    @classmethod
+    async def _update(cls, usernames: list[str], increment: int):
+        async with cls._redis().pipeline(transaction=False) as pipe:
+            for username in usernames:
+                pipe.execute_command(*cls._incrby(username, increment))
+            await pipe.execute()
+
+    @classmethod
+    async def build(cls):
+        """Заполнение фильтра из БД, выполняется одним воркером"""
+        redis = cls._redis()
+        if await redis.exists(cls._ready_key):
+            return
+        if not await redis.set(cls._lock_key, 1, nx=True, ex=600):
+            return
+        try:
+            await redis.delete(cls._key)
+            total = 0
+            async with async_session() as session:
+                usernames = await session.stream_scalars(
+                    select(UsersAccounts.username).execution_options(yield_per=cls._chunk)
+                )
+                async for chunk in usernames.partitions():
+                    await cls._update(chunk, 1)
+                    total += len(chunk)
+            await redis.set(cls._ready_key, 1)
+            logger.info(f"Username filter built: {total} names, {cls._size} counters, "
+                        f"{cls._hashes} hashes")
+        except RedisError as e:
+            # Фильтр без ready_key не используется, проверки идут в БД
+            logger.exception(e)
+        finally:
+            await redis.delete(cls._lock_key)
@@ -2,22 +2,58 @@ import logging
 from contextlib import asynccontextmanager
 
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
 import redis.asyncio as aioredis
 from fastapi_cache import FastAPICache
 from fastapi_cache.backends.redis import RedisBackend
 
-from config import settings, setup_logging
+from config import settings
 from database.models import create_tables
-from endpoints.routers import profile, service
+from endpoints.routers import profile, service, reference, monitoring
+from helpers.cache import ProfileCache
+from helpers.cloud_storage import CloudMediaStorageAdapter
+from helpers.cross_service import CrossService
+from helpers.geo import GeoIndex
+from helpers.images import ImageProcessor
+from helpers.log import setup_logging
+from helpers.media_gc import MediaReaper
+from helpers.metrics import EventLoopMonitor, MetricsMiddleware, mark_process_dead, render
+from helpers.outbox import OutboxRelay
+from helpers.publisher import Publisher
+from helpers.registration import CommunityRegistrations
+from helpers.security import Hasher
+from helpers.statistic import StatisticAggregator
+from helpers.username_filter import UsernameFilter
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await create_tables()
+    await GeoIndex.load()
     redis = aioredis.from_url(f"redis://{settings.REDIS_HOST}", encoding="utf-8", decode_responses=True)
     FastAPICache.init(RedisBackend(redis), prefix="fastapi-cache")
+    await UsernameFilter.build()
+    await Publisher.start()
+    CrossService.start()
+    CommunityRegistrations.start()
+    ProfileCache.start()
+    StatisticAggregator.start()
+    OutboxRelay.start()
+    MediaReaper.start()
+    EventLoopMonitor.start()
     yield
+    await EventLoopMonitor.stop()
+    await CommunityRegistrations.stop()
+    await MediaReaper.stop()
+    await OutboxRelay.stop()
+    await StatisticAggregator.stop()
+    await ProfileCache.stop()
+    await Publisher.close()
+    await CrossService.close()
+    Hasher.shutdown()
+    CloudMediaStorageAdapter.shutdown()
+    ImageProcessor.shutdown()
+    mark_process_dead()
 
 app = FastAPI(
     debug=settings.mode,
@@ -29,9 +65,12 @@ app = FastAPI(
 setup_logging()
 logger = logging.getLogger(__name__)
 
+app.add_middleware(MetricsMiddleware)
 
 app.include_router(profile, prefix="/v2/users")
 app.include_router(service, prefix="/v2/service")
+app.include_router(reference, prefix="/v2")
+app.include_router(monitoring, prefix="/v2/service")
 
 
 @app.get("/")
@@ -41,5 +80,11 @@ async def root():
             "application-version": settings.ORIGIN_VERSION}
 
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    content, content_type = render()
+    return Response(content, headers={"Content-Type": content_type})
+
+
 if __name__ == "__main__":
     uvicorn.run(app, port=8001)